@@ -1,3 +1,4 @@
+import os
 import pandas as pd 
 import numpy as np
 from matplotlib.patches import Polygon
@@ -5,16 +6,12 @@ from scipy.interpolate import UnivariateSpline
 from scipy.optimize import differential_evolution, dual_annealing, direct
 import matplotlib.pyplot as plt
 import talwani
+import inversion
+import mcmc
 
 profile = pd.read_csv('test_profile.csv',delimiter=',',header=None)
 #profile = pd.read_csv('Iom1.csv',delimiter=',',header=None)
 
-def objective(coords):
-    coords = coords.reshape((2, npoints),order ='F')
-    result = talwani.talwani(xp, pnts2poly(coords), density)
-    print(f'Objective: {(np.sum(np.abs(np.abs(result) -np.abs(y_fine))))}')
-    return np.sum(np.abs(np.abs(result) -np.abs(y_fine)))
-
 def pnts2poly(points):
     """
     Takes random coordinates and converts them to a coherant polygon. 
@@ -48,7 +45,10 @@ xmin = min(profile[0])
 xmax = max(profile[0]*1000)
 ymin = 0
 ymax = 20_000
-density = 450  # Kg/m3
+#density = None solves for the density as well: it is worked out exactly for every candidate body (within density_bounds), so the search isn't any slower.
+#Set it to a number (e.g. 450) to hold it fixed.
+density = None  # Kg/m3
+density_bounds = (0, 1000)
 G = 6.67e-11  # NM2/kg3
 SI2mGAL = 1e5
 npoints = 3 # number of points I want the model to solve for.
@@ -59,34 +59,96 @@ spline = UnivariateSpline(profile[0]*1000, profile[1])
 x_fine = np.linspace(xmin, xmax, int(np.round(xmax, 0)))
 y_fine = spline(x_fine)
 
-#optimal = minimize(objective, in_guess,method='L-BFGS-B').x
+#Where the misfit is worked out:
+#"observed" only uses the real stations in the profile (each with an optional weight, e.g. 1/uncertainty)
+#"spline" uses the spline through the profile at every metre (the old behaviour, much slower)
+#Either way xp / the spline grid is still used to plot the final model.
+misfit_at = "observed"
+x_obs = np.asarray(profile[0]*1000, dtype=float)
+y_obs = np.asarray(profile[1], dtype=float)
+weights = np.ones(len(x_obs))
+
+if misfit_at == "observed":
+    x_fit, y_fit, w_fit = x_obs, y_obs, weights
+else:
+    x_fit, y_fit, w_fit = x_fine, y_fine, np.ones(len(x_fine))
+
+#optimal = minimize(problem, in_guess,method='L-BFGS-B').x
 #This minimize() func only finds a local minimum :(), not a global minimum
 
-optimal = differential_evolution(
-                                objective,
-                                bounds= [(xmin,xmax),(-ymax,ymin)]*npoints,
-                                ).x
-
-optimal_coords = pnts2poly(optimal.reshape((2, npoints),order='F'))
-
-optimized_result = talwani.talwani(xp,optimal_coords, density) 
-
-Poly = Polygon(optimal_coords.T,closed=True, edgecolor = 'black', facecolor='gray')
-
-plt.figure()
-plt.subplot(211)
-plt.plot(profile[0]*1000,profile[1],label="Profile")
-plt.plot(xp, optimized_result,label="optimal")
-#plt.plot(xp, y_fine,label="spline")
-plt.legend()
-plt.xlabel("Distance (m)")
-plt.ylabel("Gravity (mGal)")
-
-plt.subplot(212)
-plt.gca().add_patch(Poly)
-plt.scatter(optimal_coords[0], optimal_coords[1])
-plt.xlim([0,xmax])
-plt.ylabel("Depth (m)")
-plt.xlabel("Distance (m)")
-plt.tight_layout()
-plt.show()
+#workers=1 scores the whole population in one vectorised call per generation (needs scipy >= 1.9),
+#workers=-1 splits it across every core instead. The Inversion can be pickled cheaply as the station arrays sit in shared memory.
+workers = 1
+
+#Progress is shown on one line in the terminal (at most once a second), and also written to this file as JSON lines if it isn't None
+progress_log = None
+
+#For long runs (e.g. on preemptible nodes): save the optimiser state to checkpoint every minute, 
+#carry on from it if it is already there, and stop early with the best model so far after max_time seconds (None for no limit).
+checkpoint = None
+max_time = None
+
+#How the body is described to the optimiser:
+#"points" - npoints free vertices, put in order with pnts2poly()
+#"star" - a centre plus npoints radii at fixed angles (no sorting, and a much smaller search space), smoothness > 0 favours smoother outlines
+parameterisation = "points"
+smoothness = 0.
+
+#Sample the uncertainty of the model around the best fit with an ensemble MCMC sampler (see mcmc.py), and plot the 5-95% range of the basin depth.
+#The chain is written to chain_file as it goes. The weights are taken as 1/uncertainty (mGal) of each station.
+uncertainty = False
+n_walkers = 32
+n_steps = 2000
+chain_file = "auto_chain.npy"
+
+if __name__ == "__main__":
+    resume = checkpoint if checkpoint is not None and os.path.exists(checkpoint) else None
+    progress = inversion.Progress([inversion.print_progress], log=progress_log)
+    if parameterisation == "star":
+        problem = inversion.StarInversion(x_fit, y_fit, npoints, density, [(xmin,xmax),(-ymax,ymin)], smoothness=smoothness, weights=w_fit, density_bounds=density_bounds)
+    else:
+        problem = inversion.Inversion(x_fit, y_fit, npoints, density, [(xmin,xmax),(-ymax,ymin)], weights=w_fit, density_bounds=density_bounds)
+    with problem:
+        optimal = problem.solve(workers=workers, progress=progress, checkpoint=checkpoint, resume=resume, max_time=max_time).x
+    print()
+
+    optimal_coords = problem.polygons(optimal)[0]
+    optimal_density = problem.densities(optimal)[0]
+    print(f"Density: {optimal_density} Kg/m3")
+
+    optimized_result = talwani.talwani(xp,optimal_coords, optimal_density) 
+
+    if uncertainty:
+        posterior = mcmc.Posterior(problem)
+        best = np.append(optimal, optimal_density) if posterior.sample_density else optimal
+        #Walkers start in a small ball around the best fit
+        scatter = 1e-3 * (posterior.high - posterior.low)
+        start = np.clip(best + scatter * np.random.default_rng().normal(size=(n_walkers, posterior.n_dims)), posterior.low, posterior.high)
+        samples = mcmc.sample(posterior, start, n_steps, workers=workers, chain=chain_file, 
+                              progress=inversion.Progress([inversion.print_progress]))
+        print()
+        kept = samples["chain"][n_steps // 2:].reshape(-1, posterior.n_dims)
+        envelope = mcmc.depth_envelope(posterior.polygons(kept), xp[::max(len(xp) // 500, 1)])
+
+    Poly = Polygon(optimal_coords.T,closed=True, edgecolor = 'black', facecolor='gray')
+
+    plt.figure()
+    plt.subplot(211)
+    plt.plot(profile[0]*1000,profile[1],label="Profile")
+    plt.plot(xp, optimized_result,label="optimal")
+    #plt.plot(xp, y_fine,label="spline")
+    plt.legend()
+    plt.xlabel("Distance (m)")
+    plt.ylabel("Gravity (mGal)")
+
+    plt.subplot(212)
+    plt.gca().add_patch(Poly)
+    plt.scatter(optimal_coords[0], optimal_coords[1])
+    if uncertainty:
+        plt.fill_between(xp[::max(len(xp) // 500, 1)], -envelope[0], -envelope[2], color='tab:blue', alpha=0.3, label="5-95% depth")
+        plt.legend()
+    plt.xlim([0,xmax])
+    plt.ylabel("Depth (m)")
+    plt.xlabel("Distance (m)")
+    plt.tight_layout()
+    plt.show()
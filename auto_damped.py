@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd 
 import talwani
+import inversion
 
 profile = pd.read_csv('test_profile.csv',delimiter=',',header=None)
 
@@ -58,43 +59,20 @@ def make_jacobian(xp, polygon_cords, density):
     xp: numpy array
         Points along the x-axis.
     polygon_cords: numpy array
-        Coordinates of the polygon vertices.
+        Coordinates of the (closed) polygon vertices.
     density: float
         Density of the rock.
 
     Returns:
     Jacobian_matrix: numpy array
-        Jacobian matrix.
+        Jacobian matrix with shape (n_stations, 2*N + 1), N being the number of unique vertices. 
+        The columns are the derivatives of g_z with respect to [x_0 ... x_N-1, z_0 ... z_N-1, density], from talwani.talwani_jacobian().
     """
+    gz_base, dg_dx, dg_dz, dg_ddensity = talwani.talwani_jacobian(xp, polygon_cords, density)
 
-    jacobian = np.empty((len(xp), len(xp)))
-    print(jacobian.shape)
-    print("")
-    #Calculate base gravitational attraction
-    gz_base = talwani.talwani(xp, polygon_cords, density)
-    
-    #Delta for the finite differences
-    delta = 1e-6
-
-    #Add the small pertubation to all of the variable paramaters 
-    gz_per = talwani.talwani(xp+delta, polygon_cords, density)
-
-    fin_diff = (
-        (
-        gz_per - gz_base
-        ) / delta
-    )
-    print(fin_diff.T.shape)
-    print("")
-    print(jacobian)
-    print("")
-    print(fin_diff)
-    print("")
-    print(np.eye(len(xp)))
-    print("")
-
-    print(np.eye(len(xp))@ fin_diff.reshape((len(xp),1)))
-    return 
+    jacobian = np.hstack((dg_dx, dg_dz, dg_ddensity[:, None]))
+
+    return jacobian
 
 
 #Defining coordinates to model within
@@ -110,4 +88,25 @@ npoints = 3 # number of points I want the model to solve for.
 xp = np.linspace(xmin, xmax, int(np.round(xmax, 0)))
 coords = pnts2poly(test_coords)
 
-print(make_jacobian(xp,coords, density))
+print(make_jacobian(xp,coords, density).shape)
+
+#Damped least squares (Levenberg-Marquardt) inversion at the observed stations, starting from a box under the middle of the profile.
+#The sediment basin is a negative density contrast, so the density is fitted between -1000 and 0.
+x_obs = np.asarray(profile[0]*1000, dtype=float)
+y_obs = np.asarray(profile[1], dtype=float)
+start = np.array([
+    [0.3*xmax, 0.6*xmax, 0.6*xmax, 0.3*xmax, 0.3*xmax],
+    [-500, -500, -4000, -4000, -500]
+])
+
+result = inversion.levenberg_marquardt(x_obs, y_obs, start, -density, 
+                                       bounds=[(xmin,xmax),(-ymax,ymin)], density_bounds=(-1000, 0))
+print(f"{result['message']} after {result['iterations']} iterations ({result['n_forward']} forward calls)")
+print(f"Misfit: {result['misfit']}, density: {result['density']}")
+print(result['polygon'])
+
+#The same basin with 4 to 20 vertices in one run: each model is warm started from the one before by splitting the edges that most need another vertice.
+family = inversion.progressive(x_obs, y_obs, [4, 5, 6, 7, 10, 12, 20], [(xmin,xmax),(-ymax,ymin)], result['density'], 
+                               start=result['polygon'], density_bounds=(-1000, 0))
+for model in family:
+    print(f"{model['n_vertices']} vertices: misfit {model['misfit']:.3g}, density {model['density']:.1f} ({model['n_forward']} forward calls)")
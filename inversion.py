@@ -0,0 +1,1011 @@
+import os
+import sys
+import json
+import time
+import pickle
+import inspect
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.stats import qmc
+import scipy
+import talwani
+
+#Inversion.solve() drives scipy's differential evolution solver directly so its state can be checkpointed. It is not public, so it may move
+try:
+    from scipy.optimize._differentialevolution import DifferentialEvolutionSolver
+except ImportError:
+    DifferentialEvolutionSolver = None
+
+#Shared memory blocks this process has already attached to, so unpickling an Inversion in a worker only opens each block once
+attached_memory = {}
+
+
+def unpack(params, n_vertices):
+    """
+    Splits a parameter vector [x_0 ... x_N-1, z_0 ... z_N-1, (density)] back into a closed polygon (2 x N+1) and the density (None if it isn't in the vector).
+    """
+    x = params[:n_vertices]
+    z = params[n_vertices:2*n_vertices]
+    polygon = np.vstack((np.append(x, x[0]), np.append(z, z[0])))
+    density = params[2*n_vertices] if len(params) > 2*n_vertices else None
+    return polygon, density
+
+def levenberg_marquardt(xp, g_obs, polygon_cords, density, weights=None, bounds=None, fit_density=True, density_bounds=(-np.inf, np.inf),
+                        max_iter=50, tol=1e-6, damping=1e-3, callback=None):
+    """
+    Damped least squares (Levenberg-Marquardt) inversion for the vertices (and density) of a single polygon, using the analytic Jacobian from talwani.talwani_jacobian().
+
+    Minimises sum(weights * (g_z - g_obs))^2. Each step solves (J'J + lambda D) step = -J'r, with D the diagonal of J'J.
+    J'J is eigen-decomposed once per Jacobian, so if a step is rejected the next (more heavily damped) try only costs a matrix-vector product rather than a new factorisation.
+    The damping is adapted from the gain ratio (actual / predicted misfit reduction) as in Nielsen (1999): it is relaxed after good steps and doubled (then quadrupled, ...) after rejected ones.
+    Vertices (and the density) are clipped back inside their bounds after every step.
+
+    The vertex order is kept as given (no re-sorting with pnts2poly()), so the start polygon should already be a sensible ring.
+    It is turned clockwise if needed, so a positive density gives a positive anomaly (the same convention as talwani.Polygon).
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp: numpy array
+    station x coordinates.
+
+    g_obs: numpy array
+    observed gravity (mGal) at each station.
+
+    polygon_cords: numpy array
+    the starting polygon, closed (as in talwani.talwani()).
+
+    density: float
+    the starting density (or density contrast).
+
+    weights: numpy array
+    weight for each station (e.g. 1/uncertainty), default all 1.
+
+    bounds: list
+    [(xmin, xmax), (zmin, zmax)], the box every vertice has to stay inside (the same form as the bounds in auto.py), or None.
+
+    fit_density: bool
+    if False the density is held fixed.
+
+    density_bounds: tuple
+    (min, max) density.
+
+    max_iter: int
+    maximum number of iterations (each one costs one call to talwani_jacobian() per step tried).
+
+    tol: float
+    stop once a step reduces the misfit by less than this fraction.
+
+    damping: float
+    the starting damping factor lambda.
+
+    callback: function
+    called as callback(iteration, misfit, polygon, density) after every accepted step.
+
+    ------------------------------------------------------
+    Output parameter:
+    result: dict
+    "polygon" (closed 2 x N+1), "density", "misfit" (weighted sum of squares), "g_z" (the modelled gravity at xp),
+    "iterations", "n_forward" (calls to talwani_jacobian()), "success" and "message".
+
+    ------------------------------------------------------
+    Refrences:
+
+    Marquardt, D. W. (1963), An Algorithm for Least-Squares Estimation of Nonlinear Parameters, J. Soc. Ind. Appl. Math., 11(2), 431-441.
+
+    Nielsen, H. B. (1999), Damping Parameter in Marquardt's Method, Technical Report IMM-REP-1999-05, Technical University of Denmark.
+    """
+    xp = np.asarray(xp, dtype=float)
+    g_obs = np.asarray(g_obs, dtype=float)
+    weights = np.ones(len(xp)) if weights is None else np.asarray(weights, dtype=float)
+
+    #Work with the open ring, clockwise
+    polygon = talwani.Polygon(polygon_cords)
+    n_vertices = len(polygon)
+
+    params = np.concatenate((polygon.x, polygon.z, [density]))
+    low = np.full(len(params), -np.inf)
+    high = np.full(len(params), np.inf)
+    if bounds is not None:
+        (low[:n_vertices], high[:n_vertices]), (low[n_vertices:2*n_vertices], high[n_vertices:2*n_vertices]) = bounds
+    low[-1], high[-1] = density_bounds
+    params = np.clip(params, low, high)
+    free = np.ones(len(params), dtype=bool)
+    free[-1] = fit_density
+
+    def evaluate(params):
+        poly, rho = unpack(params, n_vertices)
+        g_z, dg_dx, dg_dz, dg_ddensity = talwani.talwani_jacobian(xp, poly, rho)
+        residual = weights * (g_z - g_obs)
+        jacobian = weights[:, None] * np.hstack((dg_dx, dg_dz, dg_ddensity[:, None]))
+        return g_z, residual, jacobian[:, free]
+
+    g_z, residual, jacobian = evaluate(params)
+    n_forward = 1
+    misfit = residual @ residual
+    nu = 2.
+    success = False
+    message = "Maximum number of iterations reached"
+    #Stays 0 if max_iter is 0 and the loop never runs
+    iteration = 0
+
+    for iteration in range(1, max_iter + 1):
+        JtJ = jacobian.T @ jacobian
+        gradient = jacobian.T @ residual
+        if np.max(np.abs(gradient), initial=0.) == 0.:
+            success, message = True, "Gradient is zero"
+            break
+
+        #Scale by the diagonal and factorise once, then every damping factor tried is cheap
+        scale = np.sqrt(np.diag(JtJ))
+        scale[scale == 0.] = 1.
+        eigenvalues, eigenvectors = np.linalg.eigh(JtJ / np.outer(scale, scale))
+        projected = eigenvectors.T @ (gradient / scale)
+
+        while True:
+            step = np.zeros(len(params))
+            step[free] = -(eigenvectors @ (projected / (eigenvalues + damping))) / scale
+            trial = np.clip(params + step, low, high)
+            step = trial - params
+
+            trial_g_z, trial_residual, trial_jacobian = evaluate(trial)
+            n_forward += 1
+            trial_misfit = trial_residual @ trial_residual
+
+            #Misfit reduction predicted by the linearised model for the (clipped) step
+            linear = residual + jacobian @ step[free]
+            predicted = misfit - linear @ linear
+            gain = (misfit - trial_misfit) / predicted if predicted > 0 else -1.
+
+            if gain > 0:
+                damping *= max(1. / 3., 1. - (2. * gain - 1.)**3)
+                nu = 2.
+                break
+            damping *= nu
+            nu *= 2.
+            if not np.isfinite(damping) or damping > 1e16:
+                break
+
+        if gain <= 0:
+            success, message = True, "No further reduction in misfit"
+            break
+
+        reduction = (misfit - trial_misfit) / misfit if misfit > 0 else 0.
+        params, g_z, residual, jacobian, misfit = trial, trial_g_z, trial_residual, trial_jacobian, trial_misfit
+
+        if callback is not None:
+            poly, rho = unpack(params, n_vertices)
+            callback(iteration, misfit, poly, rho)
+
+        if reduction < tol:
+            success, message = True, "Misfit reduction below tol"
+            break
+
+    poly, rho = unpack(params, n_vertices)
+
+    return {
+        "polygon": poly,
+        "density": rho,
+        "misfit": misfit,
+        "g_z": g_z,
+        "iterations": iteration,
+        "n_forward": n_forward,
+        "success": success,
+        "message": message,
+        }
+
+def run_start(args):
+    """
+    Runs levenberg_marquardt() from one starting polygon. Top level so it can be sent to a worker process by multi_start().
+    """
+    xp, g_obs, polygon_cords, density, kwargs = args
+    return levenberg_marquardt(xp, g_obs, polygon_cords, density, **kwargs)
+
+def multi_start(xp, g_obs, n_vertices, bounds, density, n_starts=32, keep=5, fit_density=True, density_bounds=(-np.inf, np.inf), 
+                workers=None, seed=None, **kwargs):
+    """
+    Global search made out of many local ones: starting polygons are spread over the bounds with a Latin hypercube, 
+    levenberg_marquardt() is run from each of them across a pool of processes, and the best fits are kept.
+    Each local run only needs tens of forward calls, so the whole search costs far fewer than differential_evolution() would.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp, g_obs:
+    station x coordinates and observed gravity (mGal).
+
+    n_vertices: int
+    number of vertices in each polygon.
+
+    bounds: list
+    [(xmin, xmax), (zmin, zmax)], the box the vertices are placed (and kept) in, the same as auto.py.
+
+    density: float
+    starting density. If fit_density is True and density_bounds are finite, the starting densities are spread over density_bounds as well.
+
+    n_starts: int
+    number of starting polygons.
+
+    keep: int
+    number of best results to return.
+
+    workers: int
+    number of processes, None uses every core, 1 runs everything in this process.
+
+    seed: int
+    seed for the Latin hypercube.
+
+    **kwargs:
+    passed on to levenberg_marquardt() (weights, max_iter, tol, ...).
+
+    ------------------------------------------------------
+    Output parameter:
+    results: list
+    the keep best results from levenberg_marquardt(), best first. Each one also has "start", the polygon it started from.
+    """
+    (xmin, xmax), (zmin, zmax) = bounds
+    spread_density = fit_density and np.all(np.isfinite(density_bounds))
+
+    #One Latin hypercube sample per start: (x, z) for every vertice, then the density
+    n_dims = 2 * n_vertices + (1 if spread_density else 0)
+    sample = qmc.LatinHypercube(d=n_dims, seed=seed).random(n_starts)
+    low = [xmin, zmin] * n_vertices + ([density_bounds[0]] if spread_density else [])
+    high = [xmax, zmax] * n_vertices + ([density_bounds[1]] if spread_density else [])
+    sample = qmc.scale(sample, low, high)
+
+    kwargs = dict(kwargs, bounds=bounds, fit_density=fit_density, density_bounds=density_bounds)
+    tasks = []
+    for row in sample:
+        points = row[:2 * n_vertices].reshape((2, n_vertices), order='F')
+        start = talwani.Polygon(points, sort=True).closed()
+        tasks.append((xp, g_obs, start, row[-1] if spread_density else density, kwargs))
+
+    if workers == 1:
+        results = [run_start(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            results = list(pool.map(run_start, tasks))
+
+    for task, result in zip(tasks, results):
+        result["start"] = task[2]
+
+    results.sort(key=lambda result: result["misfit"])
+
+    return results[:keep]
+
+def split_edges(xp, g_obs, polygon_cords, density, n_new, weights=None):
+    """
+    Adds n_new vertices to a polygon, at the midpoints of the edges where an extra vertice would reduce the misfit the most.
+
+    A vertice at the midpoint of an edge doesn't change g_z, but the misfit gradient at it (from talwani.talwani_jacobian()) 
+    shows how much moving it would help, so the edges with the largest gradient are split. 
+    If n_new is more than the number of edges, the splitting is repeated on the new polygon.
+    The vertices are kept in the order given (an anticlockwise ring isn't turned round, which would flip the sign of g_z).
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp, g_obs:
+    station x coordinates and observed gravity (mGal).
+
+    polygon_cords: numpy array
+    closed polygon (2 x N+1).
+
+    density: float
+    density of the polygon.
+
+    n_new: int
+    number of vertices to add.
+
+    weights: numpy array
+    weight for each station, default all 1.
+
+    ------------------------------------------------------
+    Output parameter:
+    polygon: numpy array
+    closed polygon (2 x N+n_new+1), with the same g_z as the one given.
+    """
+    xp = np.asarray(xp, dtype=float)
+    g_obs = np.asarray(g_obs, dtype=float)
+    weights = np.ones(len(xp)) if weights is None else np.asarray(weights, dtype=float)
+    #Work with the open ring
+    points = np.array(polygon_cords, dtype=float)
+    if points.shape[1] > 1 and np.all(points[:, 0] == points[:, -1]):
+        points = points[:, :-1]
+
+    while n_new > 0:
+        x, z = points
+        n_vertices = len(x)
+
+        #Every edge split at its midpoint: the vertices go [v_0, m_0, v_1, m_1, ...]
+        refined = np.empty((2, 2 * n_vertices))
+        refined[0, 0::2], refined[1, 0::2] = x, z
+        refined[0, 1::2] = (x + np.roll(x, -1)) / 2
+        refined[1, 1::2] = (z + np.roll(z, -1)) / 2
+
+        g_z, dg_dx, dg_dz, dg_ddensity = talwani.talwani_jacobian(xp, np.column_stack((refined, refined[:, :1])), density)
+        residual = weights**2 * (g_z - g_obs)
+        score = np.hypot(residual @ dg_dx[:, 1::2], residual @ dg_dz[:, 1::2])
+
+        k = min(n_new, n_vertices)
+        keep = np.ones(2 * n_vertices, dtype=bool)
+        keep[1::2] = False
+        keep[2 * np.argsort(score)[::-1][:k] + 1] = True
+        points = refined[:, keep]
+        n_new -= k
+
+    return np.column_stack((points, points[:, :1]))
+
+def progressive(xp, g_obs, vertex_counts, bounds, density, start=None, weights=None, n_starts=8, workers=1, seed=None, **kwargs):
+    """
+    Solves for a whole family of polygons with an increasing number of vertices in one go (e.g. the 3, 4, 5, 6, 7, 10, 12 and 20 point models in auto_models/).
+    The smallest polygon is found with multi_start() (or from start if it is given). 
+    Every later one is warm started from the previous optimum with split_edges() and then refined with levenberg_marquardt(), 
+    which only takes a handful of forward calls rather than a new global search.
+    levenberg_marquardt() can finish on an anticlockwise ring, so the warm start is turned clockwise with its density negated, 
+    which keeps g_z the same (levenberg_marquardt() would otherwise turn it round itself and flip the sign of g_z).
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp, g_obs:
+    station x coordinates and observed gravity (mGal).
+
+    vertex_counts: list
+    increasing numbers of vertices, e.g. [3, 4, 5, 6, 7, 10, 12, 20].
+
+    bounds: list
+    [(xmin, xmax), (zmin, zmax)], the box the vertices are kept in.
+
+    density: float
+    starting density.
+
+    start: numpy array
+    closed starting polygon for the first level with vertex_counts[0] vertices, if None multi_start() is used.
+
+    weights: numpy array
+    weight for each station, default all 1.
+
+    n_starts, workers, seed:
+    passed on to multi_start() for the first level.
+
+    **kwargs:
+    passed on to levenberg_marquardt() (fit_density, density_bounds, max_iter, tol, ...).
+
+    ------------------------------------------------------
+    Output parameter:
+    results: list
+    one result from levenberg_marquardt() per vertex count, each with "n_vertices" added. 
+    "n_forward" is the number of forward calls for that level, so the cost of the whole family is their sum.
+    """
+    vertex_counts = sorted(vertex_counts)
+    kwargs = dict(kwargs, weights=weights)
+
+    if start is None:
+        found = multi_start(xp, g_obs, vertex_counts[0], bounds, density, n_starts=n_starts, keep=n_starts, workers=workers, seed=seed, **kwargs)
+        result = found[0]
+        result["n_forward"] = sum(r["n_forward"] for r in found)
+    else:
+        result = levenberg_marquardt(xp, g_obs, start, density, bounds=bounds, **kwargs)
+    result["n_vertices"] = result["polygon"].shape[1] - 1
+    results = [result]
+
+    for n_vertices in vertex_counts[1:]:
+        previous = results[-1]
+        polygon = split_edges(xp, g_obs, previous["polygon"], previous["density"], n_vertices - previous["n_vertices"], weights=weights)
+        density = previous["density"]
+        x, z = polygon
+        if np.sum(x[:-1] * z[1:] - x[1:] * z[:-1]) > 0:
+            polygon, density = polygon[:, ::-1], -density
+        result = levenberg_marquardt(xp, g_obs, polygon, density, bounds=bounds, **kwargs)
+        result["n_vertices"] = n_vertices
+        results.append(result)
+
+    return results
+
+def sort_polygons(points):
+    """
+    Batched version of pnts2poly() in auto.py: puts each set of points in order around its centroid and closes it.
+    Takes coordinates in the shape (S x 2 x N) and returns S closed polygons in the shape (S x 2 x N+1).
+    """
+    d = points - np.mean(points, axis=2, keepdims=True)
+    si = np.argsort(np.arctan2(d[:, 1, :], d[:, 0, :]), axis=1)
+    sP = np.take_along_axis(points, si[:, None, :], axis=2)
+    return np.concatenate((sP, sP[:, :, :1]), axis=2)
+
+class Progress:
+    """
+    Collects how an inversion is going and passes it on as records, at most once every interval seconds, so the objective itself never has to print anything.
+    Each record is a dict with "generation", "evaluations", "evaluations_per_second", "time_per_evaluation" (s), "best_misfit" and "wall_time" (s since the start).
+
+    ------------------------------------------------------
+    Input parameters:
+
+    callbacks: list
+    functions called with every record, e.g. print_progress, or queue.put to send the records to another thread (the AutoCreateBodyWindow in main.py).
+
+    interval: float
+    minimum time (s) between records. The first record, and any update() with force=True, are always sent.
+
+    log: str
+    path of a file every record is appended to as a line of JSON, or None.
+    """
+    def __init__(self, callbacks=(), interval=1.0, log=None):
+        self.callbacks = list(callbacks)
+        self.interval = interval
+        self.log = log
+        self.start = time.perf_counter()
+        self.last_sent = None
+        self.record = None
+        #Evaluations done before this run (e.g. before a resume), left out of the rates
+        self.previous_evaluations = 0
+
+    def update(self, generation, evaluations, best_misfit, force=False):
+        """
+        Called by the optimiser (e.g. once per generation). Builds the record and sends it if interval has passed since the last one.
+        """
+        now = time.perf_counter()
+        wall_time = now - self.start
+        done = evaluations - self.previous_evaluations
+        self.record = {
+            "generation": int(generation),
+            "evaluations": int(evaluations),
+            "evaluations_per_second": done / wall_time if wall_time > 0 else 0.,
+            "time_per_evaluation": wall_time / done if done > 0 else 0.,
+            "best_misfit": float(best_misfit),
+            "wall_time": wall_time,
+            }
+        if force or self.last_sent is None or now - self.last_sent >= self.interval:
+            self.send(self.record)
+            self.last_sent = now
+
+    def send(self, record):
+        if self.log is not None:
+            with open(self.log, "a") as file:
+                file.write(json.dumps(record) + "\n")
+        for callback in self.callbacks:
+            callback(record)
+
+def print_progress(record, file=sys.stderr):
+    """
+    Progress line for the terminal, rewritten in place every time.
+    """
+    file.write(f"\rgeneration {record['generation']:5d} | {record['evaluations']:8d} evaluations | "
+               f"{record['evaluations_per_second']:8.1f} /s | best misfit {record['best_misfit']:.6g} | {record['wall_time']:7.1f} s")
+    file.flush()
+
+def check_solver(solver):
+    """
+    Checks this scipy's DifferentialEvolutionSolver keeps its state in the (private) attributes save_checkpoint() and restore_checkpoint() use,
+    so a checkpoint that could never be restored isn't written.
+    """
+    missing = [name for name in ("_nfev", "_random_population_index") if not hasattr(solver, name)]
+    if missing:
+        raise RuntimeError(f"Checkpoints are not supported with scipy {scipy.__version__}: "
+                           f"its DifferentialEvolutionSolver has no {', '.join(missing)}")
+
+def save_checkpoint(path, solver, generation, evaluations):
+    """
+    Saves the state of a running DifferentialEvolutionSolver (population, energies, random number generator and the best solution) to a .npz file.
+    The file is written next to path and then moved over it, so a run killed part way through saving still leaves the last good checkpoint.
+    """
+    random = solver.random_number_generator
+    rng_state = random.get_state() if isinstance(random, np.random.RandomState) else random.bit_generator.state
+    temporary = path + ".tmp.npz"
+    np.savez(
+            temporary,
+            population=solver.population,
+            population_energies=solver.population_energies,
+            best_x=solver.x,
+            best_misfit=solver.population_energies[0],
+            nfev=solver._nfev,
+            generation=generation,
+            evaluations=evaluations,
+            rng_state=np.frombuffer(pickle.dumps(rng_state), dtype=np.uint8),
+            #The order the solver picks population members in is shuffled in place every time, so it is part of the state as well
+            random_population_index=solver._random_population_index,
+            scipy_version=scipy.__version__,
+            )
+    os.replace(temporary, path)
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by save_checkpoint() back into a dict.
+    """
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+    state["rng_state"] = pickle.loads(state["rng_state"].tobytes())
+    state["generation"] = int(state["generation"])
+    state["evaluations"] = int(state["evaluations"])
+    state["scipy_version"] = str(state["scipy_version"]) if "scipy_version" in state else "unknown"
+    return state
+
+def restore_checkpoint(solver, state):
+    """
+    Puts a loaded checkpoint back into a new DifferentialEvolutionSolver (before solve() is called), so the population isn't scored again.
+    It has to be the same version of scipy that saved it, as the solver's private state may have changed.
+    """
+    check_solver(solver)
+    if state["scipy_version"] != scipy.__version__:
+        raise ValueError(f"Checkpoint was saved with scipy {state['scipy_version']}, it can't be restored with scipy {scipy.__version__}")
+    if solver.population.shape != state["population"].shape:
+        raise ValueError(f"Checkpoint population has shape {state['population'].shape}, but the solver's is {solver.population.shape}")
+    solver.population[:] = state["population"]
+    solver.population_energies[:] = state["population_energies"]
+    solver._nfev = int(state["nfev"])
+    solver._random_population_index[:] = state["random_population_index"]
+    random = solver.random_number_generator
+    if isinstance(random, np.random.RandomState):
+        random.set_state(state["rng_state"])
+    else:
+        random.bit_generator.state = state["rng_state"]
+
+def projected_density(unit, g_obs, weights, density_bounds=(-np.inf, np.inf)):
+    """
+    The density that minimises the misfit used by Inversion, sum(weights * | |g_z| - |g_obs| |), for each of a set of geometries, 
+    given their anomalies with a density of 1 kg/m3 (g_z is linear in density, g_z = density * unit).
+
+    The misfit is then sum(weights * |unit| * | |density| - |g_obs| / |unit| |), so the best |density| is the weighted median 
+    of |g_obs| / |unit| with weights * |unit| as the weights. The misfit only goes up moving away from it, so with bounds the clamped value is the best one.
+    As the misfit ignores signs, the density is given the sign allowed by density_bounds. If both are allowed it takes the sign whose side of the bounds 
+    gets closest to the best |density| (positive on a tie), so the result is always inside density_bounds.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    unit: numpy array
+    shape (S, n_stations), the unit density anomaly of each geometry.
+
+    g_obs, weights: numpy arrays
+    observed gravity (mGal) and weight at each station.
+
+    density_bounds: tuple
+    (min, max) density.
+
+    ------------------------------------------------------
+    Output parameter:
+    density: numpy array
+    shape (S,), the best density for each geometry.
+    """
+    unit = np.abs(np.atleast_2d(unit))
+    g_obs = np.abs(np.asarray(g_obs, dtype=float))
+
+    #Weighted median of the ratios, stations the body has no effect at get no weight
+    weight = np.broadcast_to(weights * unit, unit.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(unit > 0, g_obs / unit, 0.)
+    order = np.argsort(ratio, axis=1)
+    ratio = np.take_along_axis(ratio, order, axis=1)
+    cumulative = np.cumsum(np.take_along_axis(weight, order, axis=1), axis=1)
+    middle = np.argmax(cumulative >= cumulative[:, -1:] / 2, axis=1)
+    magnitude = ratio[np.arange(len(ratio)), middle]
+
+    low, high = density_bounds
+    if low <= 0 <= high:
+        #Each sign can reach |density| up to its own bound, the misfit only goes up moving away from magnitude so the larger clamped value wins
+        positive = np.minimum(magnitude, high)
+        negative = np.minimum(magnitude, -low)
+        return np.where(positive >= negative, positive, -negative)
+
+    #Only one sign allowed: clamp |density| into the range of the bounds
+    smallest, largest = min(abs(low), abs(high)), max(abs(low), abs(high))
+    sign = 1. if low > 0 else -1.
+    return sign * np.clip(magnitude, smallest, largest)
+
+def polygon_keys(polygons, quantum=None):
+    """
+    A key for each closed polygon in (S x 2 x M+1) that is the same for every way of writing down the same ring: 
+    whichever vertex it starts at and whichever way round it goes. 
+    If quantum (m) is given the vertices are rounded to it first, so candidates that differ by less than that share a key.
+    """
+    rings = np.asarray(polygons, dtype=float)[:, :, :-1]
+    if quantum is not None:
+        rings = np.round(rings / quantum) * quantum
+    rings = rings + 0.0   #turns -0. into 0. so they hash the same
+
+    #Always anticlockwise, starting from the vertex with the smallest x (then z), for the whole population at once
+    x, z = rings[:, 0], rings[:, 1]
+    area = np.sum(x * np.roll(z, -1, axis=1) - np.roll(x, -1, axis=1) * z, axis=1)
+    rings = np.where(area[:, None, None] < 0, rings[:, :, ::-1], rings)
+    x, z = rings[:, 0], rings[:, 1]
+    start = np.argmin(np.where(x == x.min(axis=1, keepdims=True), z, np.inf), axis=1)
+    order = (start[:, None] + np.arange(rings.shape[2])) % rings.shape[2]
+    rings = np.ascontiguousarray(np.take_along_axis(rings, order[:, None, :], axis=2))
+    return [ring.tobytes() for ring in rings.reshape(len(rings), -1)]
+
+class Inversion:
+    """
+    A polygon inversion problem (the same one auto.py solves) packed up so it can be pickled and sent to worker processes, 
+    e.g. differential_evolution(workers=-1, updating='deferred').
+
+    The station, observation and weight arrays are read only, so they are put in one shared memory block: 
+    pickling an Inversion only sends the name of the block, and workers read the arrays straight from it rather than getting a copy with every task.
+    Call close() (or use it in a with block) when finished, to free the shared memory.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp: numpy array
+    station x coordinates.
+
+    g_obs: numpy array
+    observed gravity (mGal) at each station.
+
+    npoints: int
+    number of vertices to solve for.
+
+    density: float
+    density of the body. If None the density is not searched for but solved for exactly with every candidate geometry (see projected_density()), 
+    so the optimiser only has to search the vertices. densities() gives the density that goes with a solution.
+
+    bounds: list
+    [(xmin, xmax), (zmin, zmax)], the box every vertice is searched in (the same as auto.py).
+
+    density_bounds: tuple
+    (min, max) density when density is None.
+
+    weights: numpy array
+    weight for each station, default all 1.
+
+    shared: bool
+    if False the arrays are pickled along with the object as normal.
+
+    cache_size: int
+    how many misfits to remember (least recently used dropped first), 0 turns the cache off. 
+    Default 4096 if quantum is given, otherwise off: DE almost never proposes exactly the same polygon twice, so without rounding the keys cost more than they save.
+    Candidates that make the same closed polygon (e.g. the same vertices in a different order) are only forward modelled once. 
+    The hits, misses and hit_rate attributes show how much it is saving. Each worker process keeps its own cache.
+
+    quantum: float
+    if given, vertices are rounded to this (m) for the cache key, so near duplicate candidates reuse the first one's misfit.
+    Keep it well below the accuracy you want from the model, as the optimiser can't see any improvement smaller than it.
+
+    **kwargs:
+    passed on to talwani.talwani_batch() (e.g. kernel="won_bevis").
+    """
+    def __init__(self, xp, g_obs, npoints, density, bounds, weights=None, shared=True, cache_size=None, quantum=None, 
+                 density_bounds=(-np.inf, np.inf), **kwargs):
+        xp = np.asarray(xp, dtype=float)
+        g_obs = np.asarray(g_obs, dtype=float)
+        weights = np.ones(len(xp)) if weights is None else np.asarray(weights, dtype=float)
+
+        self.npoints = npoints
+        self.density = density
+        self.density_bounds = density_bounds
+        self.bounds = list(bounds)
+        #Bounds of every parameter, in the order differential_evolution() sees them
+        self.parameter_bounds = self.bounds * npoints
+        self.kwargs = kwargs
+        self.n_stations = len(xp)
+        self.memory = None
+        self.owner = shared
+        if cache_size is None:
+            cache_size = 4096 if quantum is not None else 0
+        self.cache_size = cache_size
+        self.quantum = quantum
+        self.evaluations = 0
+        self.clear_cache()
+
+        if shared:
+            self.memory = shared_memory.SharedMemory(create=True, size=max(3 * xp.nbytes, 1))
+            self.attach_arrays()
+            self.xp[:], self.g_obs[:], self.weights[:] = xp, g_obs, weights
+            for array in (self.xp, self.g_obs, self.weights):
+                array.flags.writeable = False
+        else:
+            self.xp, self.g_obs, self.weights = xp, g_obs, weights
+
+    def attach_arrays(self):
+        """
+        Makes xp, g_obs and weights views onto the shared memory block.
+        """
+        arrays = np.ndarray((3, self.n_stations), dtype=np.float64, buffer=self.memory.buf)
+        self.xp, self.g_obs, self.weights = arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.memory is not None:
+            #Only the name of the block is sent, the arrays are picked up from it on the other side
+            state["memory"] = self.memory.name
+            for key in ("xp", "g_obs", "weights"):
+                del state[key]
+        state["owner"] = False
+        #Workers start with an empty cache rather than a copy of this one
+        state["cache"] = OrderedDict()
+        state["hits"] = state["misses"] = state["evaluations"] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.memory, str):
+            name = self.memory
+            if name not in attached_memory:
+                attached_memory[name] = shared_memory.SharedMemory(name=name)
+            self.memory = attached_memory[name]
+            self.attach_arrays()
+
+    def polygons(self, params):
+        """
+        Turns a parameter vector (2*npoints,) or a population (2*npoints, S) into closed, ordered polygons with shape (S, 2, npoints+1).
+        The parameters are [x_0, z_0, x_1, z_1, ...], the same as auto.py.
+        """
+        params = np.asarray(params, dtype=float)
+        population = params.reshape(len(params), -1)
+        coords = population.T.reshape((-1, self.npoints, 2)).transpose(0, 2, 1)
+        return sort_polygons(coords)
+
+    def __call__(self, params):
+        """
+        The misfit (the same as auto.py: sum of weights * | |g_z| - |g_obs| |) of one candidate, or of every candidate in a population (for vectorized=True).
+        Nothing is printed.
+        """
+        polygons = self.polygons(params)
+        self.evaluations += len(polygons)
+        if self.cache_size <= 0:
+            misfit = self.misfit(polygons)
+            return misfit if np.ndim(params) > 1 else misfit[0]
+
+        keys = polygon_keys(polygons, self.quantum)
+        misfit = np.empty(len(keys))
+        new = {}
+        for i, key in enumerate(keys):
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                misfit[i] = self.cache[key]
+            elif key in new:
+                #A duplicate within this population
+                self.hits += 1
+                new[key].append(i)
+            else:
+                self.misses += 1
+                new[key] = [i]
+
+        if new:
+            first = [index[0] for index in new.values()]
+            for key, value in zip(new, self.misfit(polygons[first])):
+                misfit[new[key]] = value
+                self.cache[key] = value
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return misfit if np.ndim(params) > 1 else misfit[0]
+
+    def misfit(self, polygons):
+        """
+        Forward models the closed polygons (S x 2 x M+1) and returns their S misfits, with no caching.
+        """
+        if self.density is None:
+            unit = talwani.talwani_batch(self.xp, polygons, 1.0, **self.kwargs)
+            result = unit * projected_density(unit, self.g_obs, self.weights, self.density_bounds)[:, None]
+        else:
+            result = talwani.talwani_batch(self.xp, polygons, self.density, **self.kwargs)
+        return np.sum(self.weights * np.abs(np.abs(result) - np.abs(self.g_obs)), axis=1)
+
+    def penalty(self, params):
+        """
+        The prior term added to the misfit of each candidate (params laid out as for polygons()). There isn't one here, so it is 0.
+        """
+        return np.zeros(np.shape(params)[1:])
+
+    def densities(self, params):
+        """
+        The density of each candidate: the fixed density, or (if density is None) the best one for its geometry from projected_density().
+        """
+        polygons = self.polygons(params)
+        if self.density is not None:
+            return np.full(len(polygons), float(self.density))
+        unit = talwani.talwani_batch(self.xp, polygons, 1.0, **self.kwargs)
+        return projected_density(unit, self.g_obs, self.weights, self.density_bounds)
+
+    @property
+    def hit_rate(self):
+        """
+        Fraction of misfits that came from the cache.
+        """
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+    def clear_cache(self):
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def solve(self, workers=1, vectorized=None, progress=None, checkpoint=None, checkpoint_interval=60., resume=None, 
+              max_time=None, max_evaluations=None, **kwargs):
+        """
+        Runs differential_evolution() on the problem. 
+        With workers=1 the whole population is scored in one vectorised call per generation, otherwise the candidates are split across workers
+        (-1 uses every core). Either way the population is updated once per generation (updating='deferred').
+        Extra keyword arguments go to differential_evolution() (seed or rng, popsize, maxiter, polish, ...). Returns its OptimizeResult.
+
+        ------------------------------------------------------
+        Input parameters:
+
+        progress: Progress
+        updated after every generation (needs scipy >= 1.12), and once more at the end.
+
+        checkpoint: str
+        path of a .npz file the optimiser state (population, energies, random number generator state and the best solution so far) is saved to, 
+        at most every checkpoint_interval seconds and when the run ends.
+
+        resume: str
+        path of a checkpoint to carry on from, e.g. after the process was killed. The problem, popsize and scipy version have to be the same as the run that saved it.
+        maxiter counts the generations before the resume as well, so a resumed run stops where the uninterrupted one would have.
+
+        max_time: float
+        wall-clock budget (s) for this run. 
+
+        max_evaluations: int
+        budget of misfit evaluations, including those before a resume.
+        Once either budget runs out the run stops at the end of the generation, skips polishing and returns the best solution so far (success is False).
+        """
+        if DifferentialEvolutionSolver is None:
+            raise ImportError(f"scipy {scipy.__version__} has no scipy.optimize._differentialevolution.DifferentialEvolutionSolver, which solve() needs")
+        if vectorized is None:
+            vectorized = workers == 1
+        begin = time.perf_counter()
+        start = self.evaluations
+        state = load_checkpoint(resume) if resume is not None else None
+        generations = state["generation"] if state is not None else 0
+        previous = state["evaluations"] if state is not None else 0
+        stopped = None
+        if progress is not None:
+            progress.previous_evaluations = previous
+        if state is not None:
+            kwargs["maxiter"] = max(kwargs.get("maxiter", 1000) - generations, 0)
+
+        #The solver is run directly (rather than through differential_evolution()) so its state can be saved and put back.
+        #seed / rng are turned into a RandomState here, so its state can be saved whichever of the two this version of scipy takes.
+        random = kwargs.pop("rng", kwargs.pop("seed", None))
+        if not isinstance(random, (np.random.RandomState, np.random.Generator)):
+            random = np.random.RandomState(random)
+        rng_keyword = "rng" if "rng" in inspect.signature(DifferentialEvolutionSolver).parameters else "seed"
+        kwargs[rng_keyword] = random
+        user_callback = kwargs.pop("callback", None)
+
+        def evaluations(result):
+            #nfev only counts calls, so when the population is scored in one call the candidates are counted here instead
+            return previous + (self.evaluations - start if vectorized else result.nfev)
+
+        last_saved = time.perf_counter()
+        def callback(intermediate_result):
+            nonlocal last_saved, stopped
+            generation = generations + intermediate_result.nit
+            count = evaluations(intermediate_result)
+            if progress is not None:
+                progress.update(generation, count, intermediate_result.fun)
+            if checkpoint is not None and time.perf_counter() - last_saved >= checkpoint_interval:
+                save_checkpoint(checkpoint, solver, generation, count)
+                last_saved = time.perf_counter()
+
+            if max_time is not None and time.perf_counter() - begin >= max_time:
+                stopped = "Wall-clock budget used up"
+            elif max_evaluations is not None and count >= max_evaluations:
+                stopped = "Evaluation budget used up"
+            if stopped is not None:
+                solver.polish = False
+                return True
+            return bool(user_callback(intermediate_result)) if user_callback is not None else False
+
+        with DifferentialEvolutionSolver(
+                                    self,
+                                    bounds=self.parameter_bounds,
+                                    workers=workers,
+                                    updating='deferred',
+                                    vectorized=vectorized,
+                                    callback=callback,
+                                    **kwargs,
+                                    ) as solver:
+            if checkpoint is not None:
+                check_solver(solver)
+            if state is not None:
+                restore_checkpoint(solver, state)
+            result = solver.solve()
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, solver, generations + result.nit, evaluations(result))
+
+        if stopped is not None:
+            result.success = False
+            result.message = stopped
+        if progress is not None:
+            progress.update(generations + result.nit, evaluations(result), result.fun, force=True)
+        return result
+
+    def close(self):
+        """
+        Detaches from the shared memory, and frees it if this is the Inversion that made it.
+        """
+        if self.memory is None or isinstance(self.memory, str):
+            return
+        self.xp = np.array(self.xp)
+        self.g_obs = np.array(self.g_obs)
+        self.weights = np.array(self.weights)
+        if self.owner:
+            self.memory.close()
+            self.memory.unlink()
+        self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def star_polygons(params, n_radii, bounds=None):
+    """
+    Turns star shaped model parameters [x_c, z_c, r_0 ... r_N-1] (or a population of them, shape (N+2, S)) into closed polygons (S x 2 x N+1).
+    Vertice k is r_k from the centre (x_c, z_c), at a fixed angle of -2*pi*k/N, so the ring is always clockwise and never crosses itself, with no sorting needed.
+    If bounds ([(xmin, xmax), (zmin, zmax)]) are given the vertices are clipped into them (e.g. so the body stops at the surface).
+    """
+    params = np.asarray(params, dtype=float)
+    population = params.reshape(len(params), -1)
+    angles = -2 * np.pi * np.arange(n_radii) / n_radii
+
+    x = population[0][:, None] + population[2:].T * np.cos(angles)
+    z = population[1][:, None] + population[2:].T * np.sin(angles)
+    if bounds is not None:
+        (xmin, xmax), (zmin, zmax) = bounds
+        x = np.clip(x, xmin, xmax)
+        z = np.clip(z, zmin, zmax)
+
+    polygons = np.stack((x, z), axis=1)
+    return np.concatenate((polygons, polygons[:, :, :1]), axis=2)
+
+class StarInversion(Inversion):
+    """
+    The same inversion as Inversion, but the body is described by a centre and n_radii radii at fixed angles (see star_polygons()) 
+    rather than n_radii free vertices that have to be put in order with pnts2poly(). 
+    Every parameter vector is a different, valid ring, so the search space has no repeated permutations and there is no sort in the objective.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp, g_obs, density, bounds, weights, shared:
+    the same as Inversion. The centre is searched for inside bounds and the vertices are clipped into it.
+
+    n_radii: int
+    number of vertices (radii).
+
+    max_radius: float
+    the largest radius searched, default half the widest side of bounds.
+
+    smoothness: float
+    weight of a prior that favours smooth outlines: smoothness * sum(((r_k+1 - r_k) / mean(r))^2) is added to the misfit. 0 turns it off.
+
+    **kwargs:
+    passed on to Inversion (cache_size, quantum, kernel, ...).
+    """
+    def __init__(self, xp, g_obs, n_radii, density, bounds, max_radius=None, smoothness=0., weights=None, shared=True, **kwargs):
+        super().__init__(xp, g_obs, n_radii, density, bounds, weights=weights, shared=shared, **kwargs)
+        (xmin, xmax), (zmin, zmax) = self.bounds
+        if max_radius is None:
+            max_radius = max(xmax - xmin, zmax - zmin) / 2
+        self.max_radius = max_radius
+        self.smoothness = smoothness
+        self.parameter_bounds = [(xmin, xmax), (zmin, zmax)] + [(0., max_radius)] * n_radii
+
+    def polygons(self, params):
+        """
+        Closed, clockwise polygons (S x 2 x n_radii+1) for a parameter vector (n_radii+2,) or a population (n_radii+2, S).
+        """
+        return star_polygons(params, self.npoints, self.bounds)
+
+    def __call__(self, params):
+        """
+        The misfit from Inversion, plus the smoothness prior on the radii.
+        """
+        return super().__call__(params) + self.penalty(params)
+
+    def penalty(self, params):
+        """
+        The smoothness prior of each candidate: smoothness * sum(((r_k+1 - r_k) / mean(r))^2), going round from the last radius back to the first.
+        """
+        params = np.asarray(params, dtype=float)
+        if self.smoothness == 0:
+            return np.zeros(params.shape[1:])
+        radii = params[2:]
+        change = np.diff(radii, axis=0, append=radii[:1]) / np.maximum(np.mean(radii, axis=0), 1e-12)
+        return self.smoothness * np.sum(change**2, axis=0)
@@ -0,0 +1,214 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.sparse.linalg import LinearOperator, lsqr, cg
+import talwani
+
+def mesh_cells(x_edges, z_edges):
+    """
+    The rectangular cells of a mesh as closed, clockwise polygons (so a positive density gives a positive g_z), shape (n_cells, 2, 5).
+    Cell k is column k // (len(z_edges) - 1) and row k % (len(z_edges) - 1), i.e. the cells go down each column in turn.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    x_edges: numpy array
+    x coordinates of the cell boundaries, increasing.
+
+    z_edges: numpy array
+    z coordinates of the cell boundaries, from the top down (e.g. np.linspace(0, -20000, 41)).
+    """
+    x_edges = np.asarray(x_edges, dtype=float)
+    z_edges = np.asarray(z_edges, dtype=float)
+    x0, z0 = np.meshgrid(x_edges[:-1], z_edges[:-1], indexing='ij')
+    x1, z1 = np.meshgrid(x_edges[1:], z_edges[1:], indexing='ij')
+    x0, x1, z0, z1 = (a.ravel() for a in (x0, x1, z0, z1))
+
+    #Top left, top right, bottom right, bottom left, back to the start
+    x = np.stack((x0, x1, x1, x0, x0), axis=1)
+    z = np.stack((z0, z0, z1, z1, z0), axis=1)
+    return np.stack((x, z), axis=1)
+
+def sensitivity_block(args):
+    """
+    Columns start:stop of the sensitivity matrix. Top level so it can be sent to a worker process by sensitivity_matrix().
+    If path is given the block is written straight into the .npy file there, rather than sent back.
+    """
+    xp, cells, start, stop, path, kwargs = args
+    block = talwani.talwani_batch(xp, cells[start:stop], 1.0, **kwargs).T
+    if path is None:
+        return block
+    matrix = np.load(path, mmap_mode='r+')
+    matrix[:, start:stop] = block
+    matrix.flush()
+    return None
+
+def sensitivity_matrix(xp, x_edges, z_edges, path=None, workers=1, block_size=256, **kwargs):
+    """
+    The (n_stations, n_cells) sensitivity matrix of a mesh of rectangular cells (see mesh_cells()):
+    element [i, k] is g_z (mGal) at station i from cell k with a density of 1 kg/m3, so the anomaly of any density model m is matrix @ m.
+    It is worked out once with the Talwani kernel (talwani.talwani_batch(), block_size cells at a time, spread over worker processes),
+    and can be kept on disk as a memory mapped .npy file to reuse for any data, weights or regularisation.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp: numpy array
+    station x coordinates.
+
+    x_edges, z_edges: numpy arrays
+    cell boundaries (see mesh_cells()).
+
+    path: str
+    .npy file to keep the matrix in. If it already holds the matrix for the same stations, mesh and kwargs (stored next to it in path + ".mesh.npz")
+    it is just opened, otherwise it is calculated and written there. None keeps the matrix in memory.
+
+    workers: int
+    number of processes, None uses every core.
+
+    block_size: int
+    number of cells worked out in one batch.
+
+    **kwargs:
+    passed on to talwani.talwani_batch() (e.g. kernel="won_bevis").
+
+    ------------------------------------------------------
+    Output parameter:
+    matrix: numpy array
+    shape (n_stations, n_cells), a read only memmap if path was given.
+    """
+    xp = np.asarray(xp, dtype=float)
+    x_edges = np.asarray(x_edges, dtype=float)
+    z_edges = np.asarray(z_edges, dtype=float)
+    cells = mesh_cells(x_edges, z_edges)
+    shape = (len(xp), len(cells))
+    #The kernel options change the matrix too (e.g. kernel or dtype), so they are kept with the mesh as text
+    options = json.dumps(kwargs, sort_keys=True, default=str)
+
+    if path is not None and os.path.exists(path) and os.path.exists(path + ".mesh.npz"):
+        with np.load(path + ".mesh.npz") as mesh:
+            same = all(np.array_equal(mesh[key], value) for key, value in (("xp", xp), ("x_edges", x_edges), ("z_edges", z_edges)))
+            same = same and "kwargs" in mesh.files and str(mesh["kwargs"]) == options
+        if same:
+            matrix = np.load(path, mmap_mode='r')
+            if matrix.shape == shape:
+                return matrix
+
+    if path is not None:
+        #Remove the old mesh record first, so an interrupted run can't be mistaken for a finished one
+        if os.path.exists(path + ".mesh.npz"):
+            os.remove(path + ".mesh.npz")
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape).flush()
+
+    tasks = [(xp, cells, start, min(start + block_size, len(cells)), path, kwargs) for start in range(0, len(cells), block_size)]
+    if workers == 1:
+        blocks = [sensitivity_block(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            blocks = list(pool.map(sensitivity_block, tasks))
+
+    if path is None:
+        return np.hstack(blocks)
+    np.savez(path + ".mesh.npz", xp=xp, x_edges=x_edges, z_edges=z_edges, kwargs=options)
+    return np.load(path, mmap_mode='r')
+
+def depth_weights(x_edges, z_edges, z0=None, beta=1.):
+    """
+    Depth weighting for each cell (Li and Oldenburg, 1998): w = (depth + z0)^(-beta/2), at the depth of the middle of the cell.
+    Without it a smallest model puts all the density just below the stations, as the kernel there is so much larger.
+    beta = 1 matches the 1/r fall off of a 2D kernel (smaller values put the density shallower), z0 defaults to half the thickness of the top row of cells.
+    The weights are scaled so the largest is 1.
+    """
+    z_edges = np.asarray(z_edges, dtype=float)
+    depth = -(z_edges[:-1] + z_edges[1:]) / 2
+    if z0 is None:
+        z0 = abs(z_edges[1] - z_edges[0]) / 2
+    weights = (depth - depth.min() + z0)**(-beta / 2)
+    weights = np.tile(weights / weights.max(), len(x_edges) - 1)
+    return weights
+
+def linear_inversion(matrix, g_obs, alpha=1., weights=None, cell_weights=None, reference=None, method="lsqr", tol=1e-8, max_iter=None):
+    """
+    Density model of a mesh of cells that fits the data with the smallest (depth weighted) model:
+    minimises |weights * (matrix @ m - g_obs)|^2 + alpha^2 * |cell_weights * (m - reference)|^2.
+    It is linear, so it only needs products with matrix and its transpose (which work straight off a memory mapped matrix from sensitivity_matrix()),
+    solved with LSQR or conjugate gradients on the normal equations.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    matrix: numpy array
+    (n_stations, n_cells) sensitivity matrix, from sensitivity_matrix().
+
+    g_obs: numpy array
+    observed gravity (mGal) at each station.
+
+    alpha: float
+    regularisation, larger gives a smaller model and a worse fit.
+
+    weights: numpy array
+    weight of each station (e.g. 1/uncertainty), default all 1.
+
+    cell_weights: numpy array
+    weight of each cell in the regularisation, e.g. depth_weights(). Default all 1.
+
+    reference: numpy array
+    density model to stay close to, default 0.
+
+    method: str
+    "lsqr" or "cg".
+
+    tol: float
+    stopping tolerance of the solver.
+
+    max_iter: int
+    maximum number of iterations, default from the solver.
+
+    ------------------------------------------------------
+    Output parameter:
+    result: dict
+    "density" (n_cells,) in kg/m3, "g_z" the modelled gravity at the stations, "misfit" |weights * (g_z - g_obs)|^2 and "iterations".
+
+    ------------------------------------------------------
+    Refrences:
+
+    Li, Y. and Oldenburg, D. W. (1998), 3-D inversion of gravity data, Geophysics, 63(1), 109-119.
+
+    Paige, C. C. and Saunders, M. A. (1982), LSQR: An Algorithm for Sparse Linear Equations and Sparse Least Squares, ACM Trans. Math. Softw., 8(1), 43-71.
+    """
+    n_stations, n_cells = matrix.shape
+    g_obs = np.asarray(g_obs, dtype=float)
+    weights = np.ones(n_stations) if weights is None else np.asarray(weights, dtype=float)
+    cell_weights = np.ones(n_cells) if cell_weights is None else np.asarray(cell_weights, dtype=float)
+    reference = np.zeros(n_cells) if reference is None else np.asarray(reference, dtype=float)
+
+    #With u = cell_weights * (m - reference) the regularisation is just alpha^2 |u|^2: solve for u
+    residual = weights * (g_obs - matrix @ reference)
+    operator = LinearOperator(
+                            (n_stations, n_cells),
+                            matvec=lambda u: weights * (matrix @ (np.ravel(u) / cell_weights)),
+                            rmatvec=lambda r: (matrix.T @ (weights * np.ravel(r))) / cell_weights,
+                            dtype=np.float64,
+                            )
+
+    if method == "lsqr":
+        u, stop, iterations = lsqr(operator, residual, damp=alpha, atol=tol, btol=tol, iter_lim=max_iter)[:3]
+    elif method == "cg":
+        normal = LinearOperator((n_cells, n_cells), matvec=lambda u: operator.rmatvec(operator.matvec(u)) + alpha**2 * np.ravel(u), dtype=np.float64)
+        iterations = 0
+        def count(u):
+            nonlocal iterations
+            iterations += 1
+        u, info = cg(normal, operator.rmatvec(residual), rtol=tol, maxiter=max_iter, callback=count)
+    else:
+        raise ValueError(f"Unknown method {method!r}, use 'lsqr' or 'cg'")
+
+    density = reference + u / cell_weights
+    g_z = matrix @ density
+    return {
+        "density": density,
+        "g_z": g_z,
+        "misfit": float(np.sum((weights * (g_z - g_obs))**2)),
+        "iterations": int(iterations),
+        }
@@ -1,4 +1,5 @@
 import tkinter as tk
+import queue
 import customtkinter
 from PIL import Image, ImageTk, ImageGrab
 from tktooltip import ToolTip
@@ -265,6 +266,26 @@ class AutoCreateBodyWindow(customtkinter.CTk):
         label_text = "Slider Label"
         self.slider_label = tk.Label(self.slider_progressbar_frame, text=label_text)
         self.slider_label.grid(row=0, column=1, padx=(10, 20), pady=(10, 10), sticky="ns")
+
+        #Progress of a running inversion. It runs in another thread and puts its inversion.Progress records on this queue:
+        #e.g. inversion.Progress([window.progress_queue.put])
+        self.progress_queue = queue.Queue()
+        self.progress_label = customtkinter.CTkLabel(self, text="", justify="left")
+        self.progress_label.grid(row=1, column=0, padx=(20, 20), pady=(10, 10), sticky="w")
+        self.after(200, self.poll_progress)
+
+    def poll_progress(self):
+        """
+        Shows the latest progress record (if any arrived) and checks again in 200 ms.
+        """
+        record = None
+        while not self.progress_queue.empty():
+            record = self.progress_queue.get_nowait()
+        if record is not None:
+            self.progress_label.configure(text=f"Generation {record['generation']}, {record['evaluations']} evaluations "
+                                               f"({record['evaluations_per_second']:.0f}/s)\n"
+                                               f"Best misfit: {record['best_misfit']:.4g}, {record['wall_time']:.0f} s")
+        self.after(200, self.poll_progress)
         
 
 class EditBodyWindow(customtkinter.CTk):
@@ -0,0 +1,244 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import talwani
+
+class Posterior:
+    """
+    Log posterior of the model parameters of an inversion.Inversion (or inversion.StarInversion) problem, for sample().
+    The likelihood is the one that goes with the misfit the inversions minimise: log L = -sum(weights * | |g_z| - |g_obs| |),
+    i.e. independent Laplace errors with a scale of 1/weights at each station (so use weights = 1/uncertainty).
+    The prior is uniform inside the problem's bounds, times exp(-problem.penalty()), so e.g. the smoothness prior of a StarInversion is kept:
+    the log posterior is minus the misfit the optimiser minimises.
+
+    Called with a whole batch of parameter vectors (n_walkers, n_dims) it forward models them all with one talwani.talwani_batch() call.
+    It can be pickled (the problem's arrays stay in shared memory), so batches can be split across processes.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    problem: inversion.Inversion
+    the geometry (the parameters are problem.parameter_bounds long, laid out as problem.polygons() expects), stations and data.
+
+    sample_density: bool
+    if True the density is sampled as well, as the last parameter, inside problem.density_bounds (which then have to be finite).
+    Default True if problem.density is None. As the misfit ignores signs, density_bounds should not allow both signs.
+    """
+    def __init__(self, problem, sample_density=None):
+        if sample_density is None:
+            sample_density = problem.density is None
+        if not sample_density and problem.density is None:
+            raise ValueError("The problem has no fixed density, so the density has to be sampled")
+
+        self.problem = problem
+        self.sample_density = sample_density
+        self.n_geometry = len(problem.parameter_bounds)
+        bounds = list(problem.parameter_bounds)
+        if sample_density:
+            if not np.all(np.isfinite(problem.density_bounds)):
+                raise ValueError(f"Sampling the density needs finite density_bounds, not {problem.density_bounds}")
+            bounds.append(tuple(problem.density_bounds))
+        self.low, self.high = np.array(bounds, dtype=float).T
+        self.n_dims = len(bounds)
+
+    def polygons(self, params):
+        """
+        Closed polygons (S x 2 x M+1) for parameter vectors with shape (S, n_dims).
+        """
+        return self.problem.polygons(np.atleast_2d(params)[:, :self.n_geometry].T)
+
+    def densities(self, params):
+        """
+        The density of each parameter vector (S, n_dims).
+        """
+        params = np.atleast_2d(params)
+        return params[:, -1] if self.sample_density else np.full(len(params), float(self.problem.density))
+
+    def __call__(self, params):
+        """
+        Log posterior (up to a constant) of each parameter vector in params (S, n_dims), -inf outside the bounds.
+        """
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        log_prob = np.full(len(params), -np.inf)
+        inside = np.all((params >= self.low) & (params <= self.high), axis=1)
+        if not np.any(inside):
+            return log_prob
+
+        problem = self.problem
+        unit = talwani.talwani_batch(problem.xp, self.polygons(params[inside]), 1.0, **problem.kwargs)
+        g_z = unit * self.densities(params[inside])[:, None]
+        log_prob[inside] = -np.sum(problem.weights * np.abs(np.abs(g_z) - np.abs(problem.g_obs)), axis=1)
+        log_prob[inside] -= problem.penalty(params[inside, :self.n_geometry].T)
+        return log_prob
+
+def evaluate(log_prob, points, pool, workers):
+    """
+    log_prob of a batch of points, split into one batch per worker if there is a pool.
+    """
+    if pool is None or len(points) < 2:
+        return log_prob(points)
+    parts = np.array_split(points, min(workers, len(points)))
+    return np.concatenate(list(pool.map(log_prob, parts)))
+
+def sample(log_prob, p0, n_steps, a=2., workers=1, chain=None, chunk=100, seed=None, progress=None):
+    """
+    Affine invariant ensemble sampler (the stretch move of Goodman and Weare (2010), as used by emcee), with the parallel update of Foreman-Mackey et al. (2013):
+    the walkers are split in two halves and each half is moved using the other, so every proposal in a half can be scored together.
+    Each half step is one call to log_prob with the whole half (one batched forward calculation with Posterior),
+    split across worker processes if workers > 1.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    log_prob: function
+    takes a batch of points (n, n_dims) and returns their n log probabilities, e.g. a Posterior. Has to be picklable if workers > 1.
+
+    p0: numpy array
+    starting positions of the walkers (n_walkers, n_dims). n_walkers should be even and at least 2 * n_dims, with every start inside the prior.
+
+    n_steps: int
+    number of steps to take.
+
+    a: float
+    scale of the stretch move.
+
+    workers: int
+    number of processes to spread each batch over, None or -1 (any negative number) uses every core, the same as Inversion.solve().
+
+    chain: str
+    path of a .npy file to write the chain (n_steps, n_walkers, n_dims) to, the log probabilities go in a second file ending _log_prob.npy.
+    They are written with np.lib.format.open_memmap every chunk steps, so only chunk steps are ever held in memory and a long run can be read while it goes.
+    None keeps the whole chain in memory.
+
+    chunk: int
+    number of steps held in memory between writes.
+
+    seed: int
+    seed for the random numbers.
+
+    progress: inversion.Progress
+    updated after every step, with the highest log probability of the current walkers (negated, so it reads as a misfit) as best_misfit.
+
+    ------------------------------------------------------
+    Output parameter:
+    result: dict
+    "chain" (n_steps, n_walkers, n_dims) and "log_prob" (n_steps, n_walkers), memmaps if chain was given,
+    "acceptance_fraction" of each walker and "n_forward", the number of points scored.
+
+    ------------------------------------------------------
+    Refrences:
+
+    Goodman, J. and Weare, J. (2010), Ensemble samplers with affine invariance, Commun. Appl. Math. Comput. Sci., 5(1), 65-80.
+
+    Foreman-Mackey, D., Hogg, D. W., Lang, D. and Goodman, J. (2013), emcee: The MCMC Hammer, Publ. Astron. Soc. Pac., 125(925), 306-312.
+    """
+    rng = np.random.default_rng(seed)
+    positions = np.array(p0, dtype=float)
+    n_walkers, n_dims = positions.shape
+    if n_walkers < 4 or n_walkers % 2:
+        raise ValueError(f"Need an even number of at least 4 walkers, not {n_walkers}")
+    if workers is None or workers < 0:
+        workers = os.cpu_count()
+    halves = (np.arange(0, n_walkers, 2), np.arange(1, n_walkers, 2))
+
+    if chain is not None:
+        base = os.path.splitext(chain)[0]
+        chain_out = np.lib.format.open_memmap(base + ".npy", mode='w+', dtype=np.float64, shape=(n_steps, n_walkers, n_dims))
+        log_prob_out = np.lib.format.open_memmap(base + "_log_prob.npy", mode='w+', dtype=np.float64, shape=(n_steps, n_walkers))
+    else:
+        chain_out = np.empty((n_steps, n_walkers, n_dims))
+        log_prob_out = np.empty((n_steps, n_walkers))
+    buffer = np.empty((min(chunk, n_steps), n_walkers, n_dims))
+    log_prob_buffer = np.empty((len(buffer), n_walkers))
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        current = evaluate(log_prob, positions, pool, workers)
+        if not np.all(np.isfinite(current)):
+            raise ValueError("Every walker has to start inside the prior")
+        n_forward = n_walkers
+        accepted = np.zeros(n_walkers)
+        written = 0
+
+        for step in range(n_steps):
+            for moving, other in (halves, halves[::-1]):
+                #Stretch move: z from g(z) ~ 1/sqrt(z) on [1/a, a]
+                z = ((a - 1.) * rng.random(len(moving)) + 1.)**2 / a
+                partners = positions[rng.choice(other, len(moving))]
+                proposal = partners + z[:, None] * (positions[moving] - partners)
+
+                proposal_log_prob = evaluate(log_prob, proposal, pool, workers)
+                n_forward += len(moving)
+                accept = np.log(rng.random(len(moving))) < (n_dims - 1) * np.log(z) + proposal_log_prob - current[moving]
+
+                positions[moving[accept]] = proposal[accept]
+                current[moving[accept]] = proposal_log_prob[accept]
+                accepted[moving[accept]] += 1
+
+            buffer[step - written] = positions
+            log_prob_buffer[step - written] = current
+            if step + 1 - written == len(buffer) or step + 1 == n_steps:
+                count = step + 1 - written
+                chain_out[written:step + 1] = buffer[:count]
+                log_prob_out[written:step + 1] = log_prob_buffer[:count]
+                if chain is not None:
+                    chain_out.flush()
+                    log_prob_out.flush()
+                written = step + 1
+
+            if progress is not None:
+                progress.update(step + 1, n_forward, -np.max(current), force=step + 1 == n_steps)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return {
+        "chain": chain_out,
+        "log_prob": log_prob_out,
+        "acceptance_fraction": accepted / n_steps,
+        "n_forward": n_forward,
+        }
+
+def depth_envelope(polygons, xs, quantiles=(0.05, 0.5, 0.95), block_size=1024):
+    """
+    Quantiles of the depth to the base of a set of polygons (e.g. posterior samples of a basin) at each x in xs.
+    The base is the deepest point of a polygon straight below x, polygons that don't reach x count as a depth of 0.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    polygons: numpy array
+    closed polygons, shape (S, 2, M+1).
+
+    xs: numpy array
+    x coordinates to work out the depth at.
+
+    quantiles: tuple
+    the quantiles wanted, e.g. (0.05, 0.5, 0.95) for the median and a 90% envelope.
+
+    block_size: int
+    number of polygons worked on at a time.
+
+    ------------------------------------------------------
+    Output parameter:
+    envelope: numpy array
+    shape (len(quantiles), len(xs)), depths (positive down, m).
+    """
+    polygons = np.asarray(polygons, dtype=float)
+    xs = np.asarray(xs, dtype=float)
+    depths = np.zeros((len(polygons), len(xs)))
+
+    for start in range(0, len(polygons), block_size):
+        block = polygons[start:start + block_size]
+        x1, x2 = block[:, 0, :-1, None], block[:, 0, 1:, None]
+        z1, z2 = block[:, 1, :-1, None], block[:, 1, 1:, None]
+
+        #Where each edge crosses the vertical line at every x (vertical edges are picked up by their end points on the neighbouring edges)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (xs - x1) / (x2 - x1)
+        crosses = (t >= 0.) & (t <= 1.)
+        z = np.where(crosses, z1 + t * (z2 - z1), np.inf)
+        base = np.min(z, axis=1)
+        depths[start:start + block_size] = np.where(np.isfinite(base), np.maximum(-base, 0.), 0.)
+
+    return np.quantile(depths, quantiles, axis=0)
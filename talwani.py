@@ -1,12 +1,24 @@
 import random
+import os
+import math
+import hashlib
+import warnings
+from collections import OrderedDict
 import numpy as np
 
+#Numba is optional, it is only needed for backend="numba" in talwani()
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
 
 #random temp density value:
 G=6.67e-11 #NM2/kg3
 SI2mGAL = 1e5
 
-def talwani(xp, polygon_cords, density):
+def talwani(xp, polygon_cords, density, mode="broadcast", chunk_size=2**14, backend="numpy", dtype=np.float64, kernel="talwani"):
     """
     This function calculates the vertical gravitational attraction (g_z) of a 2D subsurface body using the formula of Talwani et al. (1959).
     Can be accessed here: https://agupubs.onlinelibrary.wiley.com/doi/pdf/10.1029/JZ064i001p00049 (as of 03/10/23).
@@ -20,12 +32,33 @@ def talwani(xp, polygon_cords, density):
     xp: numpy array
     points along the x - axis (distance along the profile) at which points to calculate the vertical gravitational attraction at each of the corresponding points.
 
-    polygon_cords: numpy array
+    polygon_cords: numpy array or Polygon
     containing (x,z) coordinate pairs for   different vertice of the polygon in the subsurface.
+    A Polygon re-uses its cached edge constants, so repeated calls skip the geometry setup.
 
     desnity: float
     desnsity of the rock in the subsurface
 
+    mode: str
+    "broadcast" (default) evaluates every edge against every station as one (n_edges x n_stations) array computation.
+    "loop" is the original edge by edge Python loop, kept for reference.
+
+    chunk_size: int
+    the maximum number of edge-station pairs held in memory at once in "broadcast" mode. 
+    The stations are split into blocks so that n_edges * block_length <= chunk_size.
+
+    backend: str
+    "numpy" (default) or "numba". "numba" runs a compiled kernel with the stations split across every core (mode and chunk_size are ignored). 
+    If Numba isn't installed a warning is given and the NumPy kernel is used instead.
+
+    dtype: numpy dtype
+    precision used by the "broadcast" kernel. np.float32 halves the memory traffic at the cost of accuracy, 
+    use check_precision() to see how big the error is for a given model (1e-5 to 1e-3 mGal for bodies a few km across, horizontal edges included).
+
+    kernel: str
+    the edge formula used by the "broadcast" mode. "talwani" (default) is the original Talwani et al. (1959) form, see edge_terms(). 
+    "won_bevis" is the log-ratio / angle form of Won and Bevis (1987), see won_bevis_terms(), which needs far fewer trig calls.
+
     ------------------------------------------------------
     Output parameter:
     g_z: array 
@@ -40,6 +73,36 @@ def talwani(xp, polygon_cords, density):
 
     Uieda, L., V. C. Oliveira Jr, and V. C. F. Barbosa (2013), Modeling the Earth with Fatiando a Terra, Proceedings of the 12th Python in Science Conference, pp. 91-98. doi:10.25080/Majora-8b375195-010
 
+    Won, I. J., and M. Bevis (1987), Computing the gravitational and magnetic anomalies due to a polygon: Algorithms and Fortran subroutines, 
+    Geophysics, 52(2), 232-238, doi:10.1190/1.1442298.
+
+    """
+    if isinstance(polygon_cords, Polygon) and (mode == "loop" or backend == "numba"):
+        polygon_cords = polygon_cords.closed()
+
+    if backend == "numba":
+        if njit is None:
+            warnings.warn("Numba is not installed, falling back to the NumPy kernel")
+        else:
+            final = talwani_numba(xp, polygon_cords)
+            return 2*G*final*density*SI2mGAL
+    elif backend != "numpy":
+        raise ValueError(f"Unknown backend: {backend}")
+
+    if mode == "broadcast":
+        final = talwani_broadcast(xp, polygon_cords, chunk_size, dtype, kernel)
+    elif mode == "loop":
+        final = talwani_loop(xp, polygon_cords)
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    g_z = 2*G*final*density*SI2mGAL
+
+    return g_z
+
+def talwani_loop(xp, polygon_cords):
+    """
+    The original edge by edge implementation of talwani(), returning the sum over the edges before it is scaled by 2*G*density.
     """
     #x and 'y' (-y -> + z) coordinates of the polygon 
     x = polygon_cords[0,:]
@@ -99,8 +162,1100 @@ def talwani(xp, polygon_cords, density):
         temp[theta == theta_p1] = 0.
         final = final + temp
 
+    return final
+
+def edge_terms(x1, z1, x2, z2, xp):
+    """
+    Evaluates the Talwani line integral for a set of polygon edges at a set of stations, without any Python loop.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    x1, z1, x2, z2: numpy arrays
+    start (x1, z1) and end (x2, z2) coordinates of each edge, shape (n_edges, 1).
+
+    xp: numpy array
+    station x coordinates, shape (1, n_stations). Stations are on the surface (z = 0).
+
+    ------------------------------------------------------
+    Output parameter:
+    temp: array
+    the contribution of every edge at every station, shape (n_edges, n_stations). 
+    Summing over axis 0 gives the same result as the loop in talwani_loop(), apart from at the stations the 0.01 bodge touches.
+    """
+    return station_terms(edge_constants(x1, z1, x2, z2), xp)
+
+def edge_constants(x1, z1, x2, z2):
+    """
+    Works out everything in edge_terms() that only depends on the edges (not the stations), so it can be worked out once and re-used (see Polygon).
+
+    Same idea as the 0.01 bodge in talwani_loop(). Vertical and horizontal edges only depend on the edge, so they are fixed here once per edge.
+    Vertices on the surface (z = 0) are moved 0.02 below it first: arctan2(0, x) is on the wrong branch for the angle the formula needs 
+    (the limit from below the surface), which made every station NaN. 0.02 so a horizontal edge on the surface is still below it after its 0.01 bodge.
+
+    They are worked out in float64 and then cast back to the dtype of the end points. For a horizontal edge the bodge makes offset huge (~1e9), 
+    and in float32 a = xvp1 + offset loses xvp1 altogether, so station_terms() uses a * sin(phi) * cos(phi) = xvp1 * sin_cos_phi + offset_sin_cos instead, 
+    where offset_sin_cos = -z2 * (x2 - x1)^2 / length^2 stays the size of the edge.
+
+    ------------------------------------------------------
+    Output parameter:
+    edges: dict
+    arrays with the same shape as x1 (normally (n_edges, 1)): the (bodged) end points x1, z1, x2, z2, 
+    the edge angle phi with its sin, cos and tan, the edge length, offset = z2 * (x2 - x1) / (z1 - z2) (a = xvp1 + offset), 
+    sin_cos_phi = sin(phi) * cos(phi) and offset_sin_cos = offset * sin_cos_phi.
+    """
+    dtype = np.result_type(x1, z1, x2, z2)
+    x1, z1, x2, z2 = (np.asarray(v, dtype=np.float64) for v in (x1, z1, x2, z2))
+    z1 = np.where(z1 == 0., -0.02, z1)
+    z2 = np.where(z2 == 0., -0.02, z2)
+    x1 = np.where(x1 == x2, x1 + 0.01, x1)
+    z1 = np.where(z1 == z2, z1 + 0.01, z1)
+
+    phi = np.arctan2(z2 - z1, x2 - x1)
+    length = np.hypot(x2 - x1, z2 - z1)
+
+    edges = {
+        "x1": x1, "z1": z1, "x2": x2, "z2": z2,
+        "phi": phi, "sin_phi": np.sin(phi), "cos_phi": np.cos(phi), "tan_phi": np.tan(phi),
+        "length": length,
+        "offset": z2 * (x2 - x1) / (z1 - z2),
+        "sin_cos_phi": np.sin(phi) * np.cos(phi),
+        "offset_sin_cos": -z2 * (x2 - x1)**2 / length**2,
+        }
+    return {key: value.astype(dtype, copy=False) for key, value in edges.items()}
+
+def station_terms(edges, xp):
+    """
+    The station dependent part of edge_terms(), using the per edge constants from edge_constants(). Returns shape (n_edges, n_stations).
+    """
+    xv = edges["x1"] - xp
+    xvp1 = edges["x2"] - xp
+    #A station directly above a vertice is nudged 0.005 to the left, moving both ends together so they still agree with the per edge phi 
+    #(0.005 rather than 0.01 so it can't land on the other end of a vertical edge that has just been shifted by 0.01)
+    on_vertex = (xv == 0.) | (xvp1 == 0.)
+    xv[on_vertex] += 0.005
+    xvp1[on_vertex] += 0.005
+
+    #Everything that only depends on the edge is (n_edges, 1) and gets broadcast against the stations
+    tan_phi = edges["tan_phi"]
+    #a * sin(phi) * cos(phi), without forming a (see edge_constants())
+    a_sin_cos = xvp1 * edges["sin_cos_phi"] + edges["offset_sin_cos"]
+    #The angles are wanted in [0, pi]: below the surface that is arctan2(-z, -x) (= arctan2(z, x) + pi), which doesn't lose the small angles 
+    #of far away vertices to rounding the way adding pi does in float32
+    theta = np.where(edges["z1"] < 0, np.arctan2(-edges["z1"], -xv), np.arctan2(edges["z1"], xv))
+    theta_p1 = np.where(edges["z2"] < 0, np.arctan2(-edges["z2"], -xvp1), np.arctan2(edges["z2"], xvp1))
+
+    #A station in line with an edge (c = 0, as in won_bevis_terms()) adds nothing, but the log below is 0/0 or log(0) there. 
+    #It can't be avoided by the nudges: e.g. the 0.005 one can put a station exactly on the line of a vertical edge skewed by the 0.01 bodge. 
+    #c is only exactly 0 without rounding, so anything within a few rounding errors of it counts (xv and xvp1 carry the rounding of the coordinates themselves). 
+    #Only the pairs that actually come out inf or NaN are zeroed: in float32 that tolerance is wide enough to take in pairs that are fine
+    c = xv * edges["z2"] - edges["z1"] * xvp1
+    scale = (np.abs(edges["x1"]) + np.abs(edges["x2"]) + np.abs(xp)) * (np.abs(edges["z1"]) + np.abs(edges["z2"]))
+    in_line = np.abs(c) <= 8 * np.finfo(c.dtype).eps * scale
+
+    #theta == theta_p1 can give 0/0 here (more often in float32), those pairs are set to 0 straight after
+    with np.errstate(divide='ignore', invalid='ignore'):
+        temp = a_sin_cos * (
+                theta - theta_p1 + tan_phi * np.log(
+                    (np.cos(theta) * (np.tan(theta) - tan_phi)) /
+                    (np.cos(theta_p1) * (np.tan(theta_p1) - tan_phi))
+                    )
+                )
+
+    temp[(theta == theta_p1) | (in_line & ~np.isfinite(temp))] = 0.
+
+    return temp
+
+def won_bevis_terms(X, Z, xp):
+    """
+    Evaluates the edges of one or more closed polygons using the formula of Won and Bevis (1987), a cheaper alternative to edge_terms(). 
+    For an edge from (x1, z1) to (x2, z2) relative to the station:
+    Z = c / (dx^2 + dz^2) * (dz * log(r2/r1) - dx * (theta2 - theta1)), with c = x1*z2 - z1*x2
+
+    The distance and angle to each vertice are worked out once and shared by the two edges that meet there, 
+    so each vertice-station pair costs one log and one arctan2 (edge_terms() uses seven trig / log calls per edge-station pair).
+    The awkward limits don't need masks or the 0.01 bodge: a station in line with an edge (which includes a vertice sitting on the station) has c = 0, 
+    and horizontal or vertical edges have nothing to divide by.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    X, Z: numpy arrays
+    vertices, shape (..., n_vertices, 1), consecutive vertices are joined by an edge. Polygons are closed (last vertice == first vertice).
+
+    xp: numpy array
+    station x coordinates, shape (1, n_stations).
+
+    ------------------------------------------------------
+    Output parameter:
+    temp: array
+    the contribution of every edge at every station, shape (..., n_vertices - 1, n_stations). 
+    Sums to the same values as edge_terms() (apart from the stations the 0.01 bodge touches there).
+    """
+    tiny = np.finfo(np.result_type(X, xp)).tiny
+
+    xr = X - xp
+    rsq = xr**2 + Z**2
+    #tiny stops log(0) for a vertice on the station, c is 0 for both of its edges so they add nothing (the correct limit)
+    log_r = 0.5 * np.log(rsq + tiny)
+    theta = np.arctan2(Z + np.zeros_like(xr), xr)
+
+    x1, x2 = xr[..., :-1, :], xr[..., 1:, :]
+    z1, z2 = Z[..., :-1, :], Z[..., 1:, :]
+    dx = X[..., 1:, :] - X[..., :-1, :]
+    dz = z2 - z1
+
+    c = x1 * z2 - z1 * x2
+    #The angle an edge covers is in (-pi, pi], the round() takes off any 2pi jump where arctan2 wraps round
+    dtheta = theta[..., 1:, :] - theta[..., :-1, :]
+    dtheta -= 2 * np.pi * np.round(dtheta / (2 * np.pi))
+
+    #Zero length edges have c = 0 as well, so they come out as 0 rather than 0/0
+    temp = c / np.maximum(dx**2 + dz**2, tiny) * (dz * (log_r[..., 1:, :] - log_r[..., :-1, :]) - dx * dtheta)
+
+    return temp
+
+def polygon_broadcast(xp, polygon, chunk_size=2**14):
+    """
+    talwani_broadcast() for a Polygon, using its cached edge constants so only the station terms are worked out.
+    """
+    edges = polygon.edges
+    final = np.zeros(len(xp))
+    if len(polygon) == 0:
+        return final
+
+    block = max(1, chunk_size // len(polygon))
+    for start in range(0, len(xp), block):
+        stop = start + block
+        final[start:stop] = station_terms(edges, xp[None, start:stop]).sum(axis=0)
+
+    return final
+
+def to_dtype(xp, x, dtype):
+    """
+    Casts the station and vertice x coordinates to dtype. For anything less than float64 both are first moved (in float64) so the stations are centred on 0,
+    as g_z only depends on x - xp and this keeps those differences accurate in float32.
+    """
+    xp = np.asarray(xp, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    if np.dtype(dtype) != np.float64 and len(xp) > 0:
+        origin = 0.5 * (xp.min() + xp.max())
+        xp = xp - origin
+        x = x - origin
+    return xp.astype(dtype, copy=False), x.astype(dtype, copy=False)
+
+def talwani_broadcast(xp, polygon_cords, chunk_size=2**14, dtype=np.float64, kernel="talwani"):
+    """
+    Broadcast version of talwani_loop(). All of the edges are evaluated against a block of stations in one go, 
+    with the stations split into blocks so no more than chunk_size edge-station pairs are in memory at once.
+    The whole calculation is done in dtype, using edge_terms() (kernel="talwani") or won_bevis_terms() (kernel="won_bevis").
+    """
+    if kernel not in ("talwani", "won_bevis"):
+        raise ValueError(f"Unknown kernel: {kernel}")
+
+    if isinstance(polygon_cords, Polygon):
+        if kernel == "talwani" and np.dtype(dtype) == np.float64:
+            #The edge constants are already cached on the polygon
+            return polygon_broadcast(np.asarray(xp, dtype=float), polygon_cords, chunk_size)
+        polygon_cords = polygon_cords.closed()
+
+    xp, x = to_dtype(xp, polygon_cords[0,:], dtype)
+    z = np.asarray(polygon_cords[1,:]).astype(dtype)
+
+    #Same edges as talwani_loop(): the polygon is expected to be closed (last vertice == first vertice)
+    x1, x2 = x[:-1, None], x[1:, None]
+    z1, z2 = z[:-1, None], z[1:, None]
+
+    final = np.zeros(len(xp), dtype=dtype)
+    if len(x1) == 0:
+        return final
+
+    block = max(1, chunk_size // len(x1))
+    for start in range(0, len(xp), block):
+        stop = start + block
+        if kernel == "won_bevis":
+            final[start:stop] = won_bevis_terms(x[:, None], z[:, None], xp[None, start:stop]).sum(axis=0)
+        else:
+            final[start:stop] = edge_terms(x1, z1, x2, z2, xp[None, start:stop]).sum(axis=0)
+
+    return final
+
+
+
+def check_precision(xp, polygon_cords, density, dtype=np.float32, chunk_size=2**14):
+    """
+    Reports how far the reduced precision kernel is from float64 for a given model, so you can check it is good enough before using it.
+
+    In float32 the error comes from rounding in the angle terms and in the sum over the edges, so it grows with the size of the anomaly and the number of vertices.
+    For bodies a few km across at a few km depth (anomalies of ~30-90 mGal) it is around 5e-5 mGal with 3 or 4 vertices (e.g. a rectangle, with its horizontal edges), 
+    5e-4 mGal for a 400 vertice stepped basin outline and 7e-4 mGal for a 2000 vertice ellipse, 
+    so it stays inside 0.01 mGal, but it is worth checking for very large or very detailed models.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp, polygon_cords, density: 
+    the same as talwani().
+
+    dtype: numpy dtype
+    the reduced precision to test.
+
+    ------------------------------------------------------
+    Output parameter:
+    max_error: float
+    the largest difference (in mGal) from the float64 result over all of the stations.
+    """
+    g_z_64 = talwani(xp, polygon_cords, density, chunk_size=chunk_size)
+    g_z_low = talwani(xp, polygon_cords, density, chunk_size=chunk_size, dtype=dtype)
+
+    return float(np.max(np.abs(g_z_low.astype(np.float64) - g_z_64), initial=0.))
+
+def station_blocks(xmin, xmax, n_stations, block_size=2**16):
+    """
+    Generates the stations of np.linspace(xmin, xmax, n_stations) one block at a time, so a long profile (e.g. one station per metre) is never held in memory all at once.
+    """
+    step = (xmax - xmin) / (n_stations - 1) if n_stations > 1 else 0.
+    for start in range(0, n_stations, block_size):
+        stop = min(start + block_size, n_stations)
+        yield xmin + step * np.arange(start, stop)
+
+def talwani_stream(stations, polygon_cords, density, out=None, n_stations=None, block_size=2**16, chunk_size=2**14, dtype=np.float64):
+    """
+    Calculates g_z for a very large set of stations block by block, writing each block straight into the output. 
+    Only one block of stations (and chunk_size edge-station pairs) is worked on at a time, so the memory used doesn't depend on the length of the profile 
+    (apart from the output itself, which can be a file on disk).
+
+    ------------------------------------------------------
+    Input parameters:
+
+    stations: numpy array or iterable
+    either the station x coordinates, or something that yields them in blocks (e.g. station_blocks()).
+
+    polygon_cords, density:
+    the same as talwani().
+
+    out: numpy array, numpy memmap, str or None
+    where to write g_z. An array (or memmap) is filled in place. A file path creates a .npy file on disk with np.lib.format.open_memmap. 
+    None allocates a new array.
+
+    n_stations: int
+    the total number of stations. Only needed when stations is a generator and out has to be created.
+
+    block_size: int
+    the number of stations per block when stations is an array.
+
+    chunk_size, dtype:
+    the same as talwani().
+
+    ------------------------------------------------------
+    Output parameter:
+    out: array
+    g_z in mGal at every station (the same object as out if one was given).
+    """
+    if isinstance(stations, np.ndarray):
+        n_stations = len(stations)
+        blocks = (stations[start:start + block_size] for start in range(0, n_stations, block_size))
+    else:
+        blocks = stations
+
+    if out is None or isinstance(out, (str, os.PathLike)):
+        if n_stations is None:
+            raise ValueError("n_stations is needed to create the output when stations is a generator")
+        if out is None:
+            out = np.empty(n_stations, dtype=dtype)
+        else:
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(n_stations,))
+
+    position = 0
+    for block in blocks:
+        block = np.asarray(block, dtype=np.float64).ravel()
+        if position + len(block) > len(out):
+            raise ValueError(f"More stations than the output can hold ({len(out)})")
+        out[position:position + len(block)] = talwani(block, polygon_cords, density, chunk_size=chunk_size, dtype=dtype)
+        position += len(block)
+
+    if position != len(out):
+        raise ValueError(f"Got {position} stations but the output holds {len(out)}")
+
+    if isinstance(out, np.memmap):
+        out.flush()
+
+    return out
+
+def numba_kernel(xp, x, z):
+    """
+    Scalar version of talwani_broadcast() written for Numba: the per edge terms are worked out once, then a parallel loop over the stations 
+    runs a fused loop over the edges, so no temporary (n_edges x n_stations) arrays are made.
+    Uses the same per edge / per station 0.01 fixes (and surface vertice nudge) as edge_terms(), and skips the same in line station-edge pairs.
+    """
+    n_edges = len(x) - 1
+    x1 = np.empty(n_edges)
+    z1 = np.empty(n_edges)
+    z2 = np.empty(n_edges)
+    tan_phi = np.empty(n_edges)
+    sin_cos_phi = np.empty(n_edges)
+    offset = np.empty(n_edges)
+    for v in range(n_edges):
+        z1[v] = -0.02 if z[v] == 0. else z[v]
+        z2[v] = -0.02 if z[v + 1] == 0. else z[v + 1]
+        x1[v] = x[v] + 0.01 if x[v] == x[v + 1] else x[v]
+        if z1[v] == z2[v]:
+            z1[v] += 0.01
+        phi = math.atan2(z2[v] - z1[v], x[v + 1] - x1[v])
+        tan_phi[v] = math.tan(phi)
+        sin_cos_phi[v] = math.sin(phi) * math.cos(phi)
+        offset[v] = z2[v] * (x[v + 1] - x1[v]) / (z1[v] - z2[v])
+
+    final = np.zeros(len(xp))
+    for j in prange(len(xp)):
+        total = 0.
+        for v in range(n_edges):
+            xv = x1[v] - xp[j]
+            xvp1 = x[v + 1] - xp[j]
+            if xv == 0. or xvp1 == 0.:
+                xv += 0.005
+                xvp1 += 0.005
+
+            theta = math.atan2(z1[v], xv)
+            theta_p1 = math.atan2(z2[v], xvp1)
+            if theta < 0:
+                theta += math.pi
+            if theta_p1 < 0:
+                theta_p1 += math.pi
+            c = xv * z2[v] - z1[v] * xvp1
+            scale = (abs(x1[v]) + abs(x[v + 1]) + abs(xp[j])) * (abs(z1[v]) + abs(z2[v]))
+            if theta == theta_p1 or abs(c) <= 8 * 2.220446049250313e-16 * scale:
+                continue
+
+            total += (xvp1 + offset[v]) * sin_cos_phi[v] * (
+                    theta - theta_p1 + tan_phi[v] * math.log(
+                        (math.cos(theta) * (math.tan(theta) - tan_phi[v])) /
+                        (math.cos(theta_p1) * (math.tan(theta_p1) - tan_phi[v]))
+                        )
+                    )
+        final[j] = total
+
+    return final
+
+if njit is not None:
+    numba_kernel = njit(parallel=True, cache=True)(numba_kernel)
+
+def talwani_numba(xp, polygon_cords):
+    """
+    Numba version of talwani_broadcast(), returning the sum over the edges before it is scaled by 2*G*density.
+    The first call compiles the kernel (and caches it to disk), later calls run straight away.
+    """
+    xp = np.ascontiguousarray(xp, dtype=np.float64)
+    x = np.ascontiguousarray(polygon_cords[0,:], dtype=np.float64)
+    z = np.ascontiguousarray(polygon_cords[1,:], dtype=np.float64)
+    return numba_kernel(xp, x, z)
+
+def pack_polygons(polygons):
+    """
+    Packs a list of polygons (each a closed 2xN array as used by talwani()) into one vertex array plus CSR style offsets, for talwani_bodies().
+
+    ------------------------------------------------------
+    Output parameters:
+    vertices: array
+    shape (2, total number of vertices), every polygon one after the other.
+
+    offsets: array
+    shape (n_bodies + 1,), body b is vertices[:, offsets[b]:offsets[b+1]].
+    """
+    polygons = [np.asarray(p, dtype=float) for p in polygons]
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([p.shape[1] for p in polygons])
+    if len(polygons) == 0:
+        return np.zeros((2, 0)), offsets
+    vertices = np.concatenate(polygons, axis=1)
+    return vertices, offsets
+
+def talwani_bodies(xp, vertices, offsets, densities, per_body=False, chunk_size=2**14, dtype=np.float64, kernel="talwani"):
+    """
+    Calculates g_z for many 2D bodies at once, from a single packed vertex array. 
+    The edges of every body are stacked together and evaluated in one broadcast pass (see talwani_broadcast()), instead of calling talwani() once per body.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp: numpy array
+    points along the x - axis at which to calculate g_z.
+
+    vertices: numpy array
+    shape (2, total number of vertices). The (x,z) coordinates of every body, one after the other. 
+    Each body is closed (last vertice == first vertice), the same as polygon_cords in talwani(). pack_polygons() builds this from a list of polygons.
+
+    offsets: numpy array
+    CSR style offsets of length n_bodies + 1, body b is vertices[:, offsets[b]:offsets[b+1]].
+
+    densities: numpy array
+    density (or density contrast) of each body, length n_bodies.
+
+    per_body: bool
+    if True also return the anomaly of each individual body.
+
+    chunk_size: int
+    the maximum number of edge-station pairs held in memory at once.
+
+    dtype, kernel:
+    precision of the calculation and the edge formula, see talwani().
+
+    ------------------------------------------------------
+    Output parameters:
+    g_z: array
+    the summed anomaly of all of the bodies in mGal, shape (n_stations,).
+
+    g_z_bodies: array
+    only returned if per_body is True. Anomaly of each body in mGal, shape (n_bodies, n_stations).
+    """
+    vertices = np.asarray(vertices)
+    xp, vx = to_dtype(xp, vertices[0], dtype)
+    vertices = np.vstack((vx, vertices[1].astype(dtype)))
+    offsets = np.asarray(offsets, dtype=np.int64)
+    densities = np.asarray(densities).astype(dtype)
+    n_bodies = len(offsets) - 1
+
+    if len(densities) != n_bodies:
+        raise ValueError(f"Got {len(densities)} densities for {n_bodies} bodies")
+
+    #Every vertice starts an edge, apart from the last (closing) vertice of each body
+    n_edges = np.maximum(np.diff(offsets) - 1, 0)
+    starts = np.ones(vertices.shape[1], dtype=bool)
+    starts[offsets[1:][offsets[1:] > offsets[:-1]] - 1] = False
+    i = np.flatnonzero(starts)
+
+    x1, x2 = vertices[0, i, None], vertices[0, i + 1, None]
+    z1, z2 = vertices[1, i, None], vertices[1, i + 1, None]
+    rho = np.repeat(densities, n_edges)[:, None]
+
+    #Edge index of the first edge of each body (for reduceat), bodies with no edges are filled in with 0 afterwards
+    edge_offsets = np.concatenate(([0], np.cumsum(n_edges)))[:-1]
+    has_edges = n_edges > 0
+
+    final = np.zeros(len(xp), dtype=dtype)
+    if per_body:
+        final_bodies = np.zeros((n_bodies, len(xp)), dtype=dtype)
+
+    if len(i) > 0:
+        block = max(1, chunk_size // len(i))
+        for start in range(0, len(xp), block):
+            stop = start + block
+            if kernel == "won_bevis":
+                #Evaluated along the whole packed array, then the pairs that join one body to the next are dropped
+                temp = won_bevis_terms(vertices[0, :, None], vertices[1, :, None], xp[None, start:stop])[i]
+            else:
+                temp = edge_terms(x1, z1, x2, z2, xp[None, start:stop])
+            if per_body:
+                final_bodies[has_edges, start:stop] = np.add.reduceat(temp, edge_offsets[has_edges], axis=0)
+                final[start:stop] = densities @ final_bodies[:, start:stop]
+            else:
+                final[start:stop] = (rho * temp).sum(axis=0)
+
+    g_z = 2*G*final*SI2mGAL
+
+    if per_body:
+        return g_z, 2*G*final_bodies*densities[:, None]*SI2mGAL
+    return g_z
+
+def talwani_batch(xp, polygons, density, chunk_size=2**14, dtype=np.float64, kernel="talwani"):
+    """
+    Calculates g_z for a whole batch of polygons that all have the same number of vertices (for example every candidate in an optimiser population).
+    The result is the same as calling talwani() on each polygon, but the whole batch is evaluated as one broadcast computation.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp: numpy array
+    points along the x - axis at which to calculate g_z.
+
+    polygons: numpy array
+    shape (n_polygons, 2, n_vertices). Each polygons[k] is a closed polygon in the same form as polygon_cords in talwani().
+
+    density: float or numpy array
+    density of the rock, either one value for every polygon or one per polygon.
+
+    chunk_size: int
+    the maximum number of edge-station pairs held in memory at once.
+
+    dtype, kernel:
+    precision of the calculation and the edge formula, see talwani().
+
+    ------------------------------------------------------
+    Output parameter:
+    g_z: array
+    shape (n_polygons, n_stations), g_z in mGal for each polygon.
+    """
+    polygons = np.asarray(polygons)
+    xp, px = to_dtype(xp, polygons[:, 0, :], dtype)
+    polygons = np.stack((px, polygons[:, 1, :].astype(dtype)), axis=1)
+    n_polygons, _, n_vertices = polygons.shape
+    n_edges = n_polygons * (n_vertices - 1)
+
+    #Stack the edges of every polygon as if they were one big polygon, then split them back up when summing
+    x1 = polygons[:, 0, :-1].reshape(-1, 1)
+    x2 = polygons[:, 0, 1:].reshape(-1, 1)
+    z1 = polygons[:, 1, :-1].reshape(-1, 1)
+    z2 = polygons[:, 1, 1:].reshape(-1, 1)
+
+    final = np.zeros((n_polygons, len(xp)), dtype=dtype)
+    if n_edges == 0:
+        return final
+
+    block = max(1, chunk_size // n_edges)
+    for start in range(0, len(xp), block):
+        stop = start + block
+        if kernel == "won_bevis":
+            temp = won_bevis_terms(polygons[:, 0, :, None], polygons[:, 1, :, None], xp[None, start:stop])
+        else:
+            temp = edge_terms(x1, z1, x2, z2, xp[None, start:stop])
+        final[:, start:stop] = temp.reshape(n_polygons, n_vertices - 1, -1).sum(axis=1)
+
+    density = np.asarray(density).astype(dtype)
+    if density.ndim == 1:
+        density = density[:, None]
+
     g_z = 2*G*final*density*SI2mGAL
 
     return g_z
 
+def jacobian_terms(X, Z, xp):
+    """
+    Works out the line integrals that both g_z and its derivatives are built from, for every edge of one closed polygon against a block of stations.
+    The distances to each vertice are worked out once and shared by the two edges that meet there.
+
+    For an edge from P1 to P2 (relative to the station) parameterised by t in [0,1], with r(t) the distance to the station:
+    J0 = int 1/r^2 dt, J1 = int t/r^2 dt, J2 = int t^2/r^2 dt
+    The edge's contribution to the sum in talwani() is c*I0, where c = x1*z2 - z1*x2, I0 = int z/r^2 dt = z1*J0 + dz*J1 
+    (the same value as summing edge_terms(), as the log(r2/r1) and angle terms are the same ones Talwani et al. (1959) use).
+
+    ------------------------------------------------------
+    Input parameters:
+
+    X, Z: numpy arrays
+    vertices of the closed polygon, shape (n_vertices, 1).
+
+    xp: numpy array
+    station x coordinates, shape (1, n_stations).
+
+    ------------------------------------------------------
+    Output parameters:
+    forward: array
+    shape (n_edges, n_stations), the contribution of each edge to g_z (before scaling by 2*G*density).
+
+    I0, I1: arrays
+    shape (n_edges, n_stations), int z/r^2 dt and int t*z/r^2 dt along each edge.
+
+    dx, dz: arrays
+    shape (n_edges, 1), the edge vectors.
+    """
+    xr = X - xp
+    #Same 0.01 bodge as edge_terms() for a station directly above a vertice that is on the surface
+    xr[(xr == 0.) & (Z == 0.)] += 0.01
+    rsq = xr**2 + Z**2
+
+    x1, x2 = xr[:-1], xr[1:]
+    z1, z2 = Z[:-1], Z[1:]
+    r1sq, r2sq = rsq[:-1], rsq[1:]
+
+    dx = X[1:] - X[:-1]
+    dz = Z[1:] - Z[:-1]
+    d2 = dx**2 + dz**2
+    #Zero length edges add nothing, stop them dividing by 0
+    d2 = np.where(d2 == 0., np.inf, d2)
+
+    c = x1 * z2 - z1 * x2
+    dtheta = np.arctan2(c, x1 * x2 + z1 * z2)
+    #Station in line with the edge: dtheta/c -> 1/(r1*r2)
+    collinear = c == 0.
+    J0 = np.where(collinear, 1. / np.sqrt(r1sq * r2sq), dtheta / np.where(collinear, 1., c))
+
+    p1_d = x1 * dx + z1 * dz
+    J1 = (0.5 * np.log(r2sq / r1sq) - p1_d * J0) / d2
+    J2 = (1. - r1sq * J0 - 2. * p1_d * J1) / d2
+
+    I0 = z1 * J0 + dz * J1
+    I1 = z1 * J1 + dz * J2
+
+    return c * I0, I0, I1, dx, dz
+
+def talwani_jacobian(xp, polygon_cords, density, chunk_size=2**14):
+    """
+    Calculates g_z of a polygon together with its analytic derivatives with respect to every vertice coordinate and the density.
+
+    Moving a vertice only moves its two edges, so the derivative is the line integral of the g_z kernel along those edges weighted by how far 
+    each point on the edge moves (1-t on the edge leaving the vertice, t on the edge arriving at it). These integrals use the same angle and log(r2/r1) 
+    terms as g_z itself (see jacobian_terms()), so the derivatives cost about the same as one more forward calculation rather than 2N.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp: numpy array
+    points along the x - axis at which to calculate g_z.
+
+    polygon_cords: numpy array
+    closed polygon, the same as in talwani(). The last vertice is the same point as the first, so its derivatives are added to the first.
+
+    density: float
+    density of the rock in the subsurface.
+
+    chunk_size: int
+    the maximum number of edge-station pairs held in memory at once.
+
+    ------------------------------------------------------
+    Output parameters:
+    g_z: array
+    shape (n_stations,), g_z in mGal (the same as talwani()).
+
+    dg_dx, dg_dz: arrays
+    shape (n_stations, n_vertices - 1), mGal per metre moved by each (unique) vertice in x or z.
+
+    dg_ddensity: array
+    shape (n_stations,), mGal per kg/m3.
+    """
+    xp = np.asarray(xp, dtype=float)
+    X = np.asarray(polygon_cords[0,:], dtype=float)[:, None]
+    Z = np.asarray(polygon_cords[1,:], dtype=float)[:, None]
+    n_vertices = len(X)
+
+    final = np.zeros(len(xp))
+    dx_total = np.zeros((n_vertices, len(xp)))
+    dz_total = np.zeros((n_vertices, len(xp)))
+
+    if n_vertices > 1:
+        block = max(1, chunk_size // (n_vertices - 1))
+        for start in range(0, len(xp), block):
+            stop = start + block
+            forward, I0, I1, dx, dz = jacobian_terms(X, Z, xp[None, start:stop])
+            final[start:stop] = forward.sum(axis=0)
+
+            #Moving a vertice by V changes the area by V . (dz, -dx) along each edge 
+            dx_total[:-1, start:stop] += (I0 - I1) * dz
+            dx_total[1:, start:stop] += I1 * dz
+            dz_total[:-1, start:stop] -= (I0 - I1) * dx
+            dz_total[1:, start:stop] -= I1 * dx
+
+    #The closing vertice is the first vertice
+    dx_total[0] += dx_total[-1]
+    dz_total[0] += dz_total[-1]
+
+    scale = 2*G*SI2mGAL
+    g_z = scale*final*density
+    dg_dx = scale*density*dx_total[:-1].T
+    dg_dz = scale*density*dz_total[:-1].T
+    dg_ddensity = scale*final
+
+    return g_z, dg_dx, dg_dz, dg_ddensity
+
+def polygon_moments(polygon_cords, order):
+    """
+    Complex area moments of a polygon about its centroid, used by talwani_far_field().
+    With w = (x - xc) + i(z - zc), M_k = integral of w^k over the polygon area, worked out exactly from the edges with Green's theorem 
+    (M_k = 1/(2i) * contour integral of conj(w) w^k dw). The sign follows the direction of the vertices, in the same way the talwani() result does.
+
+    ------------------------------------------------------
+    Output parameters:
+    moments: complex array
+    M_0 ... M_order, divided by R^(k+2) so they stay of order 1 (M_1 is 0 about the centroid).
+
+    xc, zc: floats
+    the area centroid (the vertice mean if the area is 0).
+
+    R: float
+    the largest distance from the centroid to a vertice.
+    """
+    x = np.asarray(polygon_cords[0,:], dtype=float)
+    z = np.asarray(polygon_cords[1,:], dtype=float)
+
+    cross = x[:-1] * z[1:] - x[1:] * z[:-1]
+    area = 0.5 * np.sum(cross)
+    if area != 0.:
+        xc = np.sum((x[:-1] + x[1:]) * cross) / (6 * area)
+        zc = np.sum((z[:-1] + z[1:]) * cross) / (6 * area)
+    else:
+        xc, zc = np.mean(x[:-1]), np.mean(z[:-1])
+
+    w = (x - xc) + 1j * (z - zc)
+    R = np.max(np.abs(w))
+    if R == 0.:
+        return np.zeros(order + 1, dtype=complex), xc, zc, R
+    w = w / R
+
+    #Edge from a to b: integral of (conj(a) + e (w - a)) w^k dw from a to b, with e = conj(b - a) / (b - a)
+    a, b = w[:-1], w[1:]
+    length = b - a
+    nonzero = length != 0.
+    a, b, length = a[nonzero], b[nonzero], length[nonzero]
+    e = np.conj(length) / length
+
+    moments = np.empty(order + 1, dtype=complex)
+    for k in range(order + 1):
+        p1 = (b**(k + 1) - a**(k + 1)) / (k + 1)
+        p2 = (b**(k + 2) - a**(k + 2)) / (k + 2)
+        moments[k] = np.sum(np.conj(a) * p1 + e * (p2 - a * p1)) / 2j
+
+    return moments, xc, zc, R
+
+def talwani_far_field(xp, polygon_cords, density, tol=1e-6, order=12, **kwargs):
+    """
+    Calculates g_z using a 2D multipole expansion about the body centroid for stations far from the body, and the exact kernel (talwani()) for the rest.
+
+    Seen from a station, the body is a line mass plus higher order terms: with D = (xc - xp) + i zc the complex distance to the centroid, 
+    g_z is proportional to -Im( sum_k (-1)^k M_k / D^(k+1) ), using the moments from polygon_moments(). 
+    Keeping terms up to k = order, the error relative to the line mass field of the body is at most q^(order+1) / (1 - q), with q = R / |D| 
+    (R being the distance from the centroid to the furthest vertice). Any station where that bound is bigger than tol is calculated exactly.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp, polygon_cords, density:
+    the same as talwani().
+
+    tol: float
+    the relative error allowed at the far field stations (relative to the size of the body's line mass field there).
+
+    order: int
+    the highest multipole term used.
+
+    **kwargs:
+    passed on to talwani() for the near stations.
+
+    ------------------------------------------------------
+    Output parameter:
+    g_z: array
+    g_z in mGal at each station.
+    """
+    xp = np.asarray(xp, dtype=float)
+    polygon_cords = np.asarray(polygon_cords, dtype=float)
+
+    moments, xc, zc, R = polygon_moments(polygon_cords, order)
+    D = (xc - xp) + 1j * zc
+    q = R / np.abs(D)
+    with np.errstate(divide='ignore'):
+        far = (q < 1) & (q**(order + 1) / (1 - q) <= tol)
+
+    final = np.zeros(len(xp))
+
+    #Horner's rule in u = -R / D
+    if np.any(far):
+        u = -R / D[far]
+        series = np.zeros(len(u), dtype=complex)
+        for k in range(order, -1, -1):
+            series = series * u + moments[k]
+        final[far] = -np.imag(R**2 / D[far] * series)
+
+    g_z = 2*G*final*density*SI2mGAL
+
+    if not np.all(far):
+        g_z[~far] = talwani(xp[~far], polygon_cords, density, **kwargs)
+
+    return g_z
+
+def adaptive_stations(polygon_cords, density, xmin, xmax, pixels=1000, tol=None, n_start=33, **kwargs):
+    """
+    Picks stations for plotting the anomaly of a polygon: starting from a coarse grid, intervals are split in half (one talwani() call per level) 
+    only where the curve bends more than tol between its ends, or where the interval is wide compared to its distance from a vertice (where sharp features are). 
+    Nothing is split below one screen pixel, so the curve looks the same as a dense linspace grid for far fewer forward calculations.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    polygon_cords, density:
+    the same as talwani().
+
+    xmin, xmax: floats
+    the x limits of the plot.
+
+    pixels: int
+    the width of the plot in pixels (e.g. ax.bbox.width). Intervals narrower than (xmax - xmin) / pixels are never split.
+
+    tol: float
+    how far (in mGal) the curve can be from a straight line across an interval before it is split. 
+    Defaults to the range of the anomaly on the starting grid divided by pixels (about a pixel if the plot is square).
+
+    n_start: int
+    the number of stations in the starting grid.
+
+    **kwargs:
+    passed on to talwani().
+
+    ------------------------------------------------------
+    Output parameters:
+    xs: array
+    the stations, in order.
+
+    g_z: array
+    g_z in mGal at each station.
+    """
+    polygon_cords = np.asarray(polygon_cords, dtype=float)
+    vx = polygon_cords[0, :, None]
+    vz = polygon_cords[1, :, None]
+    min_width = (xmax - xmin) / pixels
+
+    xs = np.linspace(xmin, xmax, n_start)
+    gs = talwani(xs, polygon_cords, density, **kwargs)
+    if tol is None:
+        tol = max(np.ptp(gs) / pixels, np.finfo(float).eps)
+
+    #Intervals still to test, given by their left hand station
+    left_x, left_g = xs[:-1], gs[:-1]
+    right_x, right_g = xs[1:], gs[1:]
+    new_x, new_g = [xs], [gs]
+
+    while len(left_x) > 0:
+        mid_x = 0.5 * (left_x + right_x)
+        width = right_x - left_x
+        mid_g = talwani(mid_x, polygon_cords, density, **kwargs)
+        new_x.append(mid_x)
+        new_g.append(mid_g)
+
+        bent = np.abs(mid_g - 0.5 * (left_g + right_g)) > tol
+        distance = np.min(np.hypot(vx - mid_x, vz), axis=0)
+        near_vertex = width > 0.5 * distance
+        split = (bent | near_vertex) & (0.5 * width > min_width)
+
+        #Each split interval becomes two halves for the next level
+        left_x, left_g, right_x, right_g = (
+            np.concatenate((left_x[split], mid_x[split])),
+            np.concatenate((left_g[split], mid_g[split])),
+            np.concatenate((mid_x[split], right_x[split])),
+            np.concatenate((mid_g[split], right_g[split])),
+            )
+
+    xs = np.concatenate(new_x)
+    gs = np.concatenate(new_g)
+    order = np.argsort(xs)
+
+    return xs[order], gs[order]
+
+class TalwaniModel:
+    """
+    A single polygon that keeps the contribution of every edge at every station, so moving one vertice only re-calculates its two edges.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    xp: numpy array
+    points along the x - axis at which to calculate g_z. These are fixed for the life of the model.
+
+    polygon_cords: numpy array
+    closed polygon, the same as in talwani().
+
+    density: float
+    density of the rock in the subsurface. Can be changed at any time with model.density = ...
+
+    chunk_size: int
+    the maximum number of edge-station pairs held in memory at once when building the model.
+    """
+    def __init__(self, xp, polygon_cords, density, chunk_size=2**14):
+        self.xp = np.asarray(xp, dtype=float)
+        polygon_cords = np.asarray(polygon_cords)
+        #Stored as an open ring (no repeated closing vertice), edge v goes from vertice v to vertice v+1 (wrapping round)
+        self.x = np.array(polygon_cords[0,:-1], dtype=float)
+        self.z = np.array(polygon_cords[1,:-1], dtype=float)
+        self.density = density
+        self.chunk_size = chunk_size
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-calculates every edge from scratch (and so clears any rounding built up by lots of move_vertex() calls).
+        """
+        n = len(self.x)
+        self.edges = np.zeros((n, len(self.xp)))
+        if n > 0:
+            nxt = np.roll(np.arange(n), -1)
+            block = max(1, self.chunk_size // n)
+            for start in range(0, len(self.xp), block):
+                stop = start + block
+                self.edges[:, start:stop] = edge_terms(self.x[:, None], self.z[:, None], self.x[nxt, None], self.z[nxt, None], self.xp[None, start:stop])
+        self.total = self.edges.sum(axis=0)
+
+    def move_vertex(self, i, x, z):
+        """
+        Moves vertice i to (x, z), re-calculating only the edge arriving at it and the edge leaving it, and patching the running total.
+        """
+        n = len(self.x)
+        self.x[i] = x
+        self.z[i] = z
+
+        #Edge i-1 arrives at vertice i, edge i leaves it
+        e = np.unique([(i - 1) % n, i % n])
+        nxt = (e + 1) % n
+        new = edge_terms(self.x[e, None], self.z[e, None], self.x[nxt, None], self.z[nxt, None], self.xp[None, :])
+
+        self.total += (new - self.edges[e]).sum(axis=0)
+        self.edges[e] = new
+
+    @property
+    def polygon_cords(self):
+        """
+        The current polygon, closed in the same way as the input to talwani().
+        """
+        return np.vstack((np.append(self.x, self.x[:1]), np.append(self.z, self.z[:1])))
+
+    @property
+    def g_z(self):
+        """
+        g_z in mGal at every station, for the current polygon and density.
+        """
+        return 2*G*self.total*self.density*SI2mGAL
+
+class Polygon:
+    """
+    A polygon stored once as a clean vertex ring, with the station independent edge constants (see edge_constants()) cached until a vertice moves.
+    talwani() (and talwani_broadcast()) accept it in place of a polygon_cords array.
+
+    The ring is stored open (the closing vertice isn't repeated), with repeated vertices removed, and always running clockwise in the (x, z) plane, 
+    which is the direction that gives a positive anomaly for a positive density. 
+
+    ------------------------------------------------------
+    Input parameters:
+
+    polygon_cords: numpy array
+    (2 x N) array of (x,z) coordinates, closed or not.
+
+    sort: bool
+    if True the points are first put in order around their centroid (the same as pnts2poly() in auto.py), for an unordered set of points.
+    """
+    __slots__ = ("x", "z", "edge_cache")
+
+    def __init__(self, polygon_cords, sort=False):
+        points = np.array(polygon_cords, dtype=float)
+
+        if sort and points.shape[1] > 0:
+            d = points - np.mean(points, axis=1, keepdims=True)
+            points = points[:, np.argsort(np.arctan2(d[1, :], d[0, :]))]
+
+        #Drop repeated vertices (including the closing vertice), keeping at least one
+        if points.shape[1] > 1:
+            keep = np.any(points != np.roll(points, -1, axis=1), axis=0)
+            points = points[:, keep] if np.any(keep) else points[:, :1]
+
+        #Signed area (shoelace), positive means anticlockwise
+        x, z = points
+        if np.sum(x * np.roll(z, -1) - np.roll(x, -1) * z) > 0:
+            points = points[:, ::-1]
+
+        self.set_vertices(points[0], points[1])
+
+    def set_vertices(self, x, z):
+        """
+        Replaces the vertices (in the given order) and clears the cached edge constants.
+        """
+        self.x = np.array(x, dtype=float)
+        self.z = np.array(z, dtype=float)
+        self.x.flags.writeable = False
+        self.z.flags.writeable = False
+        self.edge_cache = None
+
+    def move_vertex(self, i, x, z):
+        """
+        Moves vertice i to (x, z). The edge constants are worked out again the next time they are needed.
+        """
+        new_x = self.x.copy()
+        new_z = self.z.copy()
+        new_x[i] = x
+        new_z[i] = z
+        self.set_vertices(new_x, new_z)
+
+    @property
+    def edges(self):
+        """
+        The edge constants from edge_constants(), each with shape (n_edges, 1). Worked out on first use and then cached.
+        """
+        if self.edge_cache is None:
+            closed = self.closed()
+            self.edge_cache = edge_constants(closed[0, :-1, None], closed[1, :-1, None], closed[0, 1:, None], closed[1, 1:, None])
+        return self.edge_cache
+
+    def closed(self):
+        """
+        The polygon as a closed (2 x N+1) array, the same form as polygon_cords in talwani().
+        """
+        return np.vstack((np.append(self.x, self.x[:1]), np.append(self.z, self.z[:1])))
+
+    def __array__(self, dtype=None, copy=None):
+        closed = self.closed()
+        return closed if dtype is None else closed.astype(dtype)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __repr__(self):
+        return f"Polygon({len(self)} vertices)"
+
+class ResponseCache:
+    """
+    Stores the unit density (1 kg/m3) anomaly of each body, keyed by its geometry and the station set. 
+    As g_z is linear in density, changing the density of any body is then just a rescale and sum of the stored responses, with no forward calculation.
+
+    ------------------------------------------------------
+    Input parameters:
+
+    max_entries: int
+    how many body responses to keep. The least recently used are dropped first.
+
+    **kwargs:
+    passed on to talwani() when a response has to be calculated (e.g. kernel="won_bevis").
+    """
+    def __init__(self, max_entries=256, **kwargs):
+        self.max_entries = max_entries
+        self.kwargs = kwargs
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(xp, polygon_cords):
+        """
+        Hash of the station coordinates and the polygon vertices.
+        """
+        digest = hashlib.sha1()
+        for array in (np.asarray(xp, dtype=float), np.asarray(polygon_cords, dtype=float)):
+            digest.update(str(array.shape).encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def unit_response(self, xp, polygon_cords):
+        """
+        g_z (mGal) of the polygon with a density of 1 kg/m3, calculated only if it isn't already stored.
+        """
+        key = self.make_key(xp, polygon_cords)
+        if key in self.responses:
+            self.hits += 1
+            self.responses.move_to_end(key)
+            return self.responses[key]
+
+        self.misses += 1
+        response = talwani(xp, polygon_cords, 1.0, **self.kwargs)
+        response.flags.writeable = False
+        self.responses[key] = response
+        if len(self.responses) > self.max_entries:
+            self.responses.popitem(last=False)
+        return response
+
+    def g_z(self, xp, polygons, densities, per_body=False):
+        """
+        The summed g_z (mGal) of a list of polygons with the given densities (or density contrasts). 
+        Bodies that have been seen before with these stations only cost a multiply and add.
+        If per_body is True the (n_bodies, n_stations) anomaly of each body is returned as well.
+        """
+        xp = np.asarray(xp, dtype=float)
+        densities = np.asarray(densities, dtype=float)
+        if len(densities) != len(polygons):
+            raise ValueError(f"Got {len(densities)} densities for {len(polygons)} bodies")
+
+        if len(polygons) == 0:
+            responses = np.zeros((0, len(xp)))
+        else:
+            responses = np.vstack([self.unit_response(xp, p) for p in polygons])
+        g_z = densities @ responses
+
+        if per_body:
+            return g_z, responses * densities[:, None]
+        return g_z
 
+    def clear(self):
+        self.responses.clear()
+        self.hits = 0
+        self.misses = 0
@@ -2,6 +2,7 @@ import random
 import numpy as np
 from matplotlib.patches import Polygon
 import matplotlib.pyplot as plt
+from talwani import adaptive_stations
 
 #random temp density value:
 density = 450 #Kg/m3
@@ -191,12 +192,12 @@ if __name__ == "__main__":
 
     Poly = Polygon(sP_closed.T,closed=True, edgecolor = 'black', facecolor='gray')
 
-    #X coordinates to calculate G_v at:
-    X_places = np.linspace(min(x_coords)-(0.5*max(x_coords)),max(x_coords)+(0.5*max(x_coords)),100*len(x_coords) )
+    #X coordinates to calculate G_v at, refined only where the curve needs it:
+    X_places, G_v = adaptive_stations(sP_closed, density, min(x_coords)-(0.5*max(x_coords)), max(x_coords)+(0.5*max(x_coords)))
 
     plt.figure()
     plt.subplot(211)
-    plt.plot(X_places,talwani(X_places,polygon_cords=sP_closed,density=density))
+    plt.plot(X_places,G_v)
     #plt.xlim([0,20_000])
     plt.xlabel("Distance along profile (m)")
     plt.ylabel("gravity anomily (mGal)")
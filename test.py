@@ -2,6 +2,7 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Circle
 from matplotlib.patches import Polygon
 import numpy as np
+from talwani import TalwaniModel, adaptive_stations
 #random temp density value:
 density = 450 #Kg/m3
 G=6.67e-11 #NM2/kg3
@@ -104,8 +105,11 @@ def talwani(xp, polygon_cords, density):
 
     return g_z
 
-def plotter(self):
+def plotter(self, moved=None):
     """
+    Re-plots the modelled anomaly for the current points. 
+    If moved is the index of the only point that has changed (and the polygon order and x limits are the same as last time), 
+    the cached TalwaniModel only re-calculates the two edges next to that point.
     """
     x_coords = self.points['x']
     y_coords = self.points['y']
@@ -134,19 +138,31 @@ def plotter(self):
 
     Poly = Polygon(sP_closed.T,closed=True, edgecolor = 'black', facecolor='gray')
 
-    #X coordinates to calculate G_v at:
-    X_places = np.linspace(min(x_coords)-(0.5*max(x_coords)),max(x_coords)+(0.5*max(x_coords)),100*len(x_coords) )
+    #X limits to calculate G_v between:
+    xlim = (min(x_coords)-(0.5*max(x_coords)), max(x_coords)+(0.5*max(x_coords)))
+
+    model = getattr(self, 'model', None)
+    if moved is not None and model is not None and np.array_equal(self.model_order, si) and self.model_xlim == xlim:
+        i = np.flatnonzero(si == moved)[0]
+        model.move_vertex(i, x_coords[moved], y_coords[moved])
+    else:
+        #Stations refined near the vertices and wherever the curve bends, down to one pixel of the anomaly axis
+        X_places, _ = adaptive_stations(sP_closed, density, *xlim, pixels=max(int(self.ax1.bbox.width), 1))
+        self.model = TalwaniModel(X_places, sP_closed, density)
+        self.model_order = si
+        self.model_xlim = xlim
 
     # plot
     self.ax1.clear()  # Clear previous plot
-    self.ax1.plot(X_places, talwani(X_places, polygon_cords=sP_closed, density=density))
+    self.ax1.plot(self.model.xp, self.model.g_z)
     self.ax1.figure.canvas.draw()
 
 class DraggablePoint:
-    def __init__(self, ax, point, points_list):
+    def __init__(self, ax, point, points_list, owner=None):
         self.ax = ax
         self.point = point
         self.points_list = points_list
+        self.owner = owner  # PointMarker that holds the anomaly axis and the cached model
         self.press = None
         self.cid_press = self.point.figure.canvas.mpl_connect('button_press_event', self.on_press)
         self.cid_release = self.point.figure.canvas.mpl_connect('button_release_event', self.on_release)
@@ -180,10 +196,12 @@ class DraggablePoint:
                 index = index[0]
                 self.points_list['x'][index] = self.point.center[0]
                 self.points_list['y'][index] = self.point.center[1]
+            else:
+                index = None
             self.press = None
-            if len(self.points['x']) >= 3 and len(self.point['y']) >= 3:
-                # Extract x and y coordinates
-                plotter(self)
+            if self.owner is not None and len(self.points_list['x']) >= 3 and len(self.points_list['y']) >= 3:
+                # Only the dragged point has moved
+                plotter(self.owner, moved=index)
 
 class PointMarker:
     def __init__(self, xlim, ylim):
@@ -220,7 +238,7 @@ class PointMarker:
                 self.points['y'].append(y)
                 marker = Circle((x, y), 0.2, color='red', picker=True)  # Red circle marker
                 self.ax.add_patch(marker)
-                self.markers.append(DraggablePoint(self.ax, marker, self.points))
+                self.markers.append(DraggablePoint(self.ax, marker, self.points, owner=self))
 
             self.fig.canvas.draw()
 